@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Fabricating a dataset shaped like the (access restricted) DBIC data to benchmark the code on:
+# mriqc JSONs of QA and human sessions, segstats JSONs and small DICOM tarballs
+
+import os
+import os.path as op
+import io
+import json
+import random
+import tarfile
+import datetime
+
+from optparse import OptionParser, Option
+
+import numpy as np
+
+# sessions are spread over these years, the layout of mriqc JSONs changed on 2018-01-01
+first_date = datetime.date(2016, 1, 1)
+n_days = 4 * 365
+layout_change = datetime.date(2018, 1, 1)
+
+qa_acquisitions = ['p2', 'p2Xs4X35mm']
+
+segstats_labels = ["Background", "Left-Accumbens-area", "Left-Amygdala", "Left-Caudate", "Left-Hippocampus",
+        "Left-Pallidum", "Left-Putamen", "Left-Thalamus-Proper", "Right-Accumbens-area", "Right-Amygdala",
+        "Right-Caudate", "Right-Hippocampus", "Right-Pallidum", "Right-Putamen", "Right-Thalamus-Proper",
+        "csf", "gray", "white"]
+
+
+def get_opt_parser():
+    # use module docstring for help output
+    p = OptionParser(usage="%prog [options] OUTPUT_DIRECTORY")
+
+    p.add_options([
+        Option("-n", "--sessions",
+               dest="sessions", type="int", default=1000,
+               help="Number of QA sessions and of human sessions [default: %default]"),
+
+        Option("--dicoms",
+               dest="dicoms", type="int", default=None,
+               help="Number of DICOM tarballs, one per human session [default: as many as "
+                    "sessions, up to 1000]"),
+
+        Option("--dicom-files",
+               dest="dicom_files", type="int", default=5,
+               help="Number of DICOM files in every tarball [default: %default]"),
+
+        Option("--seed",
+               dest="seed", type="int", default=0,
+               help="Seed of the random generators [default: %default]"),
+    ])
+
+    return p
+
+
+def session_date(i):
+    # QA sessions come one per day, with a phantom per site once all days are taken
+    return first_date + datetime.timedelta(days=i % n_days)
+
+
+def mriqc_json(rng, date, iqm):
+    """
+    an mriqc JSON of a session on `date` with `iqm` as its image quality metric
+
+    Before 2018 SAR, AcquisitionTime and TxRefAmp were only stored in bids_meta.
+    """
+    bids_meta = {
+        "ShimSetting": [rng.randint(-8000, 8000) for _ in range(8)],
+        "ImageOrientationPatientDICOM": [round(rng.uniform(-1, 1), 6) for _ in range(6)],
+        "SoftwareVersions": "syngo MR E11",
+        "ConversionSoftwareVersion": "v1.0.1",
+        "RepetitionTime": 2.0,
+    }
+    scanner = {
+        "SAR": round(rng.uniform(0.05, 0.6), 6),
+        "AcquisitionTime": "%02d:%02d:%02d.%06d" % (rng.randint(7, 20), rng.randint(0, 59), rng.randint(0, 59),
+                                                    rng.randint(0, 999999)),
+        "TxRefAmp": round(rng.uniform(200, 260), 4),
+    }
+    loaded = {iqm: rng.uniform(100, 300), "fber": rng.uniform(1000, 5000), "efc": rng.uniform(0.3, 0.6)}
+    if date < layout_change:
+        bids_meta.update(scanner)
+    else:
+        loaded.update(scanner)
+    loaded["bids_meta"] = bids_meta
+    return loaded
+
+
+def write_json(path, loaded):
+    directory = op.dirname(path)
+    if not op.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(loaded, f)
+
+
+def generate_qa(root, n, rng):
+    # BOLD mriqc JSONs of QA sessions, one per acquisition
+    for i in range(n):
+        date = session_date(i)
+        subject = "qa" if i < n_days else "qa%02d" % (i // n_days)
+        ses = date.strftime("%Y%m%d")
+        for acq in qa_acquisitions:
+            write_json(op.join(root, "qa", "sub-%s" % subject, "ses-%s" % ses, "func",
+                               "sub-%s_ses-%s_task-rest_acq-%s_bold.json" % (subject, ses, acq)),
+                       mriqc_json(rng, date, "tsnr"))
+
+
+def generate_real(root, n, rng):
+    # anat and BOLD mriqc JSONs and segstats JSONs of human sessions, one session per subject
+    for i in range(n):
+        date = first_date + datetime.timedelta(days=rng.randrange(n_days))
+        sub, ses = "sid%06d" % i, date.strftime("%Y%m%d")
+        session = op.join(root, "real", "sub-%s" % sub, "ses-%s" % ses)
+        write_json(op.join(session, "anat", "sub-%s_ses-%s_T1w.json" % (sub, ses)),
+                   mriqc_json(rng, date, "snr_total"))
+        write_json(op.join(session, "func", "sub-%s_ses-%s_task-rest_bold.json" % (sub, ses)),
+                   mriqc_json(rng, date, "tsnr"))
+        write_json(op.join(root, "segstats", "sub-%s" % sub, "ses-%s" % ses, "anat",
+                           "sub-%s_ses-%s_T1w_segstats.json" % (sub, ses)),
+                   {label: [rng.randint(100, 100000), rng.uniform(100, 100000)] for label in segstats_labels})
+
+
+def dicom_file(rng, weight, age, sex):
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.PatientWeight = weight
+    ds.PatientAge = '%03dY' % age
+    ds.PatientSex = sex
+    ds.StationName = 'MRC35033'
+    ds.ReceiveCoilName = 'HeadNeck_64'
+    ds.Rows = ds.Columns = 32
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = np.zeros((32, 32), dtype=np.uint16).tobytes()
+
+    data = io.BytesIO()
+    ds.save_as(data, enforce_file_format=True)
+    return data.getvalue()
+
+
+def generate_dicoms(root, n, n_files, rng):
+    # tarballs of a series of DICOMs of human sessions, every other one compressed
+    directory = op.join(root, "dicoms")
+    if not op.exists(directory):
+        os.makedirs(directory)
+    for i in range(n):
+        date = first_date + datetime.timedelta(days=rng.randrange(n_days))
+        compressed = i % 2
+        name = op.join(directory, "sid%06d_ses-%s_T1w.tar%s" % (i, date.strftime("%Y%m%d"),
+                                                              ".gz" if compressed else ""))
+        weight, age, sex = round(rng.uniform(45, 110), 1), rng.randint(18, 80), rng.choice("MF")
+        with tarfile.open(name, "w:gz" if compressed else "w") as tar:
+            series = tarfile.TarInfo("series")
+            series.type = tarfile.DIRTYPE
+            tar.addfile(series)
+            for j in range(n_files):
+                data = dicom_file(rng, weight, age, sex)
+                member = tarfile.TarInfo("series/%04d.dcm" % j)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+
+
+def real_frame(n, targets=segstats_labels, seed=0):
+    """
+    a DataFrame shaped as the merged real data of the notebooks (see scrape_var_significance), with `n`
+    sessions and a column per target
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp(first_date) + pd.to_timedelta(rng.integers(0, n_days, n), 'D')
+    df = pd.DataFrame({'Date': dates, 'sid': ['sub-sid%06d' % i for i in range(n)], 'ses': dates.strftime('%Y%m%d'),
+                       'age': rng.normal(40, 12, n), 'sex_male': rng.integers(0, 2, n).astype(float),
+                       'PatientWeight': rng.normal(75, 12, n), 'tsnr': rng.normal(60, 8, n),
+                       'snr_total_qa': rng.normal(200, 15, n)})
+    for i in range(6):
+        df['IOPD%d_real' % (i+1)] = rng.normal(0, 0.05, n)
+    season = np.sin(2 * np.pi * df['Date'].dt.dayofyear / 365.25)
+    for target in targets:
+        df[target] = 1000 - 2 * df['age'] + 10 * season + 0.2 * df['snr_total_qa'] + rng.normal(0, 20, n)
+    return df
+
+
+def qa_frame(n, seed=0):
+    """
+    a DataFrame shaped as the QA extraction of process_QA_metrics.py, with `n` sessions of one acquisition
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp(first_date) + pd.to_timedelta(np.arange(n) % n_days, 'D')
+    df = pd.DataFrame({'Date': dates, 'Filetype': 'task-rest_acq-p2Xs4X35mm_bold.json',
+                       'tsnr': rng.normal(220, 10, n), 'SAR': rng.uniform(0.05, 0.6, n),
+                       'AcquisitionTime': rng.integers(7 * 3600, 20 * 3600, n), 'TxRefAmp': rng.uniform(200, 260, n)})
+    for i in range(6):
+        df['IOPD%d' % (i+1)] = rng.uniform(-1, 1, n)
+    return df
+
+
+def generate(root, n, n_dicoms=None, n_dicom_files=5, seed=0):
+    rng = random.Random(seed)
+    if n_dicoms is None:
+        n_dicoms = min(n, 1000)
+    generate_qa(root, n, rng)
+    generate_real(root, n, rng)
+    generate_dicoms(root, n_dicoms, n_dicom_files, rng)
+
+
+def main(args=None):
+    parser = get_opt_parser()
+
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("an output directory is needed")
+
+    generate(args[0], options.sessions, options.dicoms, options.dicom_files, options.seed)
+
+
+if __name__ == '__main__':
+    main()
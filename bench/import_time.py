@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Checking that importing nuisancelib and the extraction scripts stays cheap: none of the heavy
+# modules they use only in some functions (plotting, statsmodels, scipy, pydicom) may be loaded
+# at import time. Exits with an error if one is, or if an import takes longer than --max-seconds
+
+import os.path as op
+import sys
+import json
+import subprocess
+
+from optparse import OptionParser, Option
+
+repo_path = op.dirname(op.dirname(op.abspath(__file__)))
+
+# module: (directory it is imported from, modules which must not be loaded by importing it)
+checks = {
+    'nuisancelib': ('ipy', ['matplotlib', 'seaborn', 'statsmodels', 'scipy', 'pylab']),
+    'process_dicoms': ('code', ['pydicom', 'pandas', 'pyarrow']),
+    'process_QA_metrics': ('code', ['pandas', 'pyarrow']),
+    'process_real_metrics': ('code', ['pandas', 'pyarrow']),
+    'process_segstats': ('code', ['pandas', 'pyarrow']),
+}
+
+# run in a fresh interpreter, printing the time the import took and the heavy modules loaded
+probe = """
+import sys, time, json
+sys.path.insert(0, %(path)r)
+start = time.perf_counter()
+import %(module)s
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in %(forbidden)r if m in sys.modules]]))
+"""
+
+
+def get_opt_parser():
+    # use module docstring for help output
+    p = OptionParser()
+
+    p.add_options([
+        Option("-m", "--max-seconds",
+               dest="max_seconds", type="float", default=None,
+               help="Fail if importing any module takes longer than this"),
+
+        Option("-r", "--repeat",
+               dest="repeat", type="int", default=3,
+               help="Number of imports to take the fastest of [default: %default]"),
+    ])
+
+    return p
+
+
+def import_time(module, directory, forbidden, repeat):
+    runs = []
+    for _ in range(repeat):
+        code = probe % dict(path=op.join(repo_path, directory), module=module, forbidden=forbidden)
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(elapsed for elapsed, _ in runs), runs[0][1]
+
+
+def main(args=None):
+    parser = get_opt_parser()
+
+    (options, args) = parser.parse_args(args)
+
+    failed = False
+    for module, (directory, forbidden) in sorted(checks.items()):
+        elapsed, loaded = import_time(module, directory, forbidden, options.repeat)
+        problems = []
+        if loaded:
+            problems.append("loads %s" % ", ".join(loaded))
+        if options.max_seconds is not None and elapsed > options.max_seconds:
+            problems.append("slower than %.3f s" % options.max_seconds)
+        print("%22s %8.3f s %s" % (module, elapsed, "FAILED: " + "; ".join(problems) if problems else "ok"))
+        failed = failed or bool(problems)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
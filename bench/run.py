@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Timing the extractors of code/ and the models of ipy/nuisancelib.py on synthetic datasets
+# (see generate.py) of increasing size
+
+import os
+import os.path as op
+import io
+import sys
+import json
+import glob
+import time
+import shutil
+import tempfile
+import contextlib
+import subprocess
+from functools import partial
+
+from optparse import OptionParser, Option
+
+import generate
+
+bench_path = op.dirname(op.abspath(__file__))
+code_path = op.join(op.dirname(bench_path), 'code')
+ipy_path = op.join(op.dirname(bench_path), 'ipy')
+
+
+def get_opt_parser():
+    # use module docstring for help output
+    p = OptionParser()
+
+    p.add_options([
+        Option("-s", "--sizes",
+               dest="sizes", default="1000,10000,100000",
+               help="Comma separated numbers of sessions to benchmark with [default: %default]"),
+
+        Option("-b", "--bench",
+               dest="benchmarks", action="append", default=None,
+               help="Only run this benchmark (can be given multiple times), one of: %s" % ", ".join(
+                   ["qa_func", "real_func", "real_anat", "segstats", "dicoms", "qa_func_latent",
+                    "qa_func_read_ahead", "dicoms_latent", "dicoms_read_ahead", "orthogonalize", "regress",
+                    "regress_fast", "scrape_var_significance"])),
+
+        Option("-w", "--work-dir",
+               dest="work_dir", default=None,
+               help="Directory to generate the datasets in, and reuse them from on later runs. "
+                    "By default a temporary directory, removed at the end"),
+
+        Option("-r", "--repeat",
+               dest="repeat", type="int", default=1,
+               help="Number of times to run every benchmark, the fastest run is reported [default: %default]"),
+
+        Option("-j", "--jobs",
+               dest="jobs", type="int", default=1,
+               help="Passed on to the JSON extractors [default: %default]"),
+
+        Option("--latency",
+               dest="latency", type="float", default=5,
+               help="Milliseconds every read waits in the *_latent and *_read_ahead benchmarks, which "
+                    "read at most 1000 files [default: %default]"),
+
+        Option("--read-ahead",
+               dest="read_ahead", type="int", default=8,
+               help="Threads reading ahead in the *_read_ahead benchmarks [default: %default]"),
+
+        Option("-o", "--output",
+               dest="output", default=None,
+               help="JSON file to write the results to"),
+    ])
+
+    return p
+
+
+def dataset(work_dir, n):
+    # generates the dataset of n sessions unless a previous run left it complete
+    root = op.join(work_dir, str(n))
+    done = op.join(root, '.generated')
+    if not op.exists(done):
+        if op.exists(root):
+            shutil.rmtree(root)
+        generate.generate(root, n)
+        open(done, 'w').close()
+    return root
+
+
+def run_script(script, args):
+    subprocess.check_call([sys.executable, op.join(code_path, script)] + args, stdout=subprocess.DEVNULL)
+
+
+def extractor(script, dataset_dir, args):
+    # benchmark running a JSON extractor over a directory of the dataset
+    def bench(root, n, options, output):
+        if op.exists(output):
+            os.remove(output)
+        run_script(script, ['-j', str(options.jobs), '-d', op.join(root, dataset_dir), '-o', output] + args)
+    return bench
+
+
+def segstats(root, n, options, output):
+    for stat in glob.glob(output.replace('.csv', '-*.csv')):
+        os.remove(stat)
+    run_script('process_segstats.py', ['-j', str(options.jobs), '-d', op.join(root, 'segstats'), '-o', output])
+
+
+def dicoms(root, n, options, output):
+    run_script('process_dicoms.py', ['-t', 'PatientWeight', '-t', 'PatientAge', '-o', output]
+               + sorted(glob.glob(op.join(root, 'dicoms', '*.tar*'))))
+
+
+def code_module(name):
+    if code_path not in sys.path:
+        sys.path.insert(0, code_path)
+    return __import__(name)
+
+
+def latent_qa_func(read_ahead):
+    # extracting QA JSONs with a delay before every read, as on a network file system
+    def bench(root, n, options, output):
+        extractlib = code_module('extractlib')
+        spec = extractlib.Spec(code_module('specs').func_fields)
+        source = code_module('bidsindex').dataset_files(op.join(root, 'qa'))[:1000]
+        reader = extractlib.LatentReader(options.latency / 1000.)
+        with contextlib.redirect_stderr(io.StringIO()):
+            for _ in extractlib.produce_rows(partial(extractlib.metric_row, spec, None), source, reader=reader,
+                                             read_ahead=options.read_ahead if read_ahead else 0):
+                pass
+    return bench
+
+
+def latent_dicoms(read_ahead):
+    # extracting DICOM attributes with a delay before reading every series
+    def bench(root, n, options, output):
+        process_dicoms = code_module('process_dicoms')
+        reader = code_module('extractlib').LatentReader(options.latency / 1000., process_dicoms.read_series)
+        source = sorted(glob.glob(op.join(root, 'dicoms', '*.tar*')))[:1000]
+        with contextlib.redirect_stderr(io.StringIO()):
+            process_dicoms.extract_parameter(source, ['PatientWeight', 'PatientAge'], output, reader=reader,
+                                             read_ahead=options.read_ahead if read_ahead else 0)
+    return bench
+
+
+def nuisancelib():
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    if ipy_path not in sys.path:
+        sys.path.insert(0, ipy_path)
+    import nuisancelib
+    # nuisancelib imports these when first used; importing them here keeps their import out of the
+    # timing of the first benchmark calling it (bench/import_time.py measures imports)
+    import scipy.stats
+    import statsmodels.api
+    import statsmodels.stats.multitest
+    return nuisancelib
+
+
+def orthogonalize(root, n, options, output):
+    import numpy as np
+    X = np.random.default_rng(0).normal(size=(n, 20))
+    nuisancelib().orthogonalize(X)
+
+
+def regress(root, n, options, output, fast=False):
+    df = generate.qa_frame(n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        nuisancelib().regress('tsnr', df, plot=False, print_summary=False, fast=fast)
+
+
+def regress_fast(root, n, options, output):
+    regress(root, n, options, output, fast=True)
+
+
+def scrape_var_significance(root, n, options, output):
+    df = generate.real_frame(n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        nuisancelib().scrape_var_significance(generate.segstats_labels, 'Seasonal', df)
+
+
+# name: (function, whether it needs the generated dataset)
+benchmarks = [
+    ('qa_func', extractor('process_QA_metrics.py', 'qa', ['-t', 'func']), True),
+    ('real_func', extractor('process_real_metrics.py', 'real', ['-t', 'func', '--select', 'datatype=func']), True),
+    ('real_anat', extractor('process_real_metrics.py', 'real', ['-t', 'anat', '--select', 'datatype=anat']), True),
+    ('segstats', segstats, True),
+    ('dicoms', dicoms, True),
+    ('qa_func_latent', latent_qa_func(False), True),
+    ('qa_func_read_ahead', latent_qa_func(True), True),
+    ('dicoms_latent', latent_dicoms(False), True),
+    ('dicoms_read_ahead', latent_dicoms(True), True),
+    ('orthogonalize', orthogonalize, False),
+    ('regress', regress, False),
+    ('regress_fast', regress_fast, False),
+    ('scrape_var_significance', scrape_var_significance, False),
+]
+
+
+def main(args=None):
+    parser = get_opt_parser()
+
+    (options, args) = parser.parse_args(args)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    selected = [b for b in benchmarks if not options.benchmarks or b[0] in options.benchmarks]
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='nuisance-bench-')
+
+    if any(not needs for _, _, needs in selected):
+        nuisancelib()  # not timing its import
+
+    results = []
+    try:
+        for n in sizes:
+            root = dataset(work_dir, n) if any(needs for _, _, needs in selected) else None
+            for name, bench, _ in selected:
+                output = op.join(work_dir, 'output-%s-%d.csv' % (name, n))
+                timings = []
+                for _ in range(options.repeat):
+                    start = time.perf_counter()
+                    bench(root, n, options, output)
+                    timings.append(time.perf_counter() - start)
+                results.append({'benchmark': name, 'sessions': n, 'seconds': min(timings)})
+                print("%25s %8d sessions %10.3f s" % (name, n, min(timings)))
+                sys.stdout.flush()
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Indexing files of a BIDS dataset (or its derivatives) by their entities
+
+import os
+import os.path as op
+import re
+import csv
+import json
+import sys
+from optparse import OptionParser, Option
+
+# entities in the order of the table columns, after the path
+entity_keys = ["sub", "ses", "task", "acq", "rec", "run"]
+columns = ["path", "datatype"] + entity_keys + ["suffix", "extension", "date", "Filetype"]
+
+entity_regex = re.compile(r'^(?P<key>[a-zA-Z0-9]+)-(?P<value>[a-zA-Z0-9]+)$')
+date_regex = re.compile(r'^[0-9]{8}')
+datatypes = {"anat", "func", "dwi", "fmap", "perf", "beh"}
+
+
+class BIDSPath(str):
+    """A path carrying the entities parsed from it (see entities())"""
+
+    def __new__(cls, path, entities):
+        self = str.__new__(cls, path)
+        self.entities = entities
+        return self
+
+    def __reduce__(self):
+        return BIDSPath, (str(self), self.entities)
+
+
+def entities(path):
+    """Parse BIDS entities of `path` into a dict with the keys of `columns`
+
+    Entities come from the file name, sub and ses also from the sub-*/ses-*
+    directories when the name does not have them. `date` is the leading
+    YYYYMMDD of the session label, and `Filetype` the file name without its
+    sub and ses entities (e.g. task-rest_acq-p2_bold.json).
+    """
+    if isinstance(path, BIDSPath):
+        return path.entities
+    path = os.fsdecode(path)
+    dirname, basename = op.split(path)
+    name, dot, extension = basename.partition('.')
+    record = dict.fromkeys(columns)
+    record["path"] = path
+    record["extension"] = dot + extension
+
+    parts = name.split('_')
+    filetype = []
+    for i, part in enumerate(parts):
+        match = entity_regex.match(part)
+        if match:
+            record[match.group('key')] = match.group('value')
+            if match.group('key') in ('sub', 'ses'):
+                continue
+        elif i == len(parts) - 1:
+            record["suffix"] = part
+        filetype.append(part)
+    record["Filetype"] = '_'.join(filetype) + record["extension"]
+
+    for directory in reversed(dirname.split(os.sep)):
+        if directory in datatypes and record["datatype"] is None:
+            record["datatype"] = directory
+        match = entity_regex.match(directory)
+        if match and match.group('key') in ('sub', 'ses') and record[match.group('key')] is None:
+            record[match.group('key')] = match.group('value')
+
+    if record["ses"]:
+        date = date_regex.match(record["ses"])
+        record["date"] = date.group(0) if date else None
+    return record
+
+
+class DatasetIndex(object):
+    """Table of the files under `root` with their BIDS entities
+
+    The tree is walked with os.scandir. With a `cache` file the listing of
+    every directory is stored along with its mtime, and later scans only
+    list directories again whose mtime changed (i.e. which had entries
+    added or removed).
+
+    Only files whose content is present are listed: broken symlinks, such
+    as annexed files which were not fetched (e.g. with `datalad get`), are
+    left out, and checked again at every scan.
+    """
+
+    def __init__(self, root, cache=None):
+        self.root = root
+        self.cache = cache
+        self.dirs = {}
+        if cache and op.exists(cache):
+            with open(cache) as f:
+                stored = json.load(f)
+            if stored.get("root") == op.abspath(root):
+                self.dirs = stored["dirs"]
+        self.records = self._scan()
+        if cache:
+            tmp = cache + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"root": op.abspath(root), "dirs": self.dirs}, f)
+            os.replace(tmp, cache)
+
+    def _scan(self):
+        records = []
+        dirs = {}
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            mtime = os.stat(path).st_mtime_ns
+            listing = self.dirs.get(path)
+            # listings cached before absent files were kept apart are listed again
+            if listing is None or listing["mtime"] != mtime or "absent" not in listing:
+                subdirs, files, absent = [], [], []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                        else:
+                            absent.append(entry.name)
+                listing = {"mtime": mtime, "dirs": sorted(subdirs), "absent": sorted(absent),
+                           "files": [entities(op.join(path, name)) for name in sorted(files)]}
+            elif listing["absent"]:
+                # fetching annexed content does not change the mtime of the directory
+                fetched = [name for name in listing["absent"] if op.isfile(op.join(path, name))]
+                if fetched:
+                    files = sorted([op.basename(record["path"]) for record in listing["files"]] + fetched)
+                    listing = {"mtime": mtime, "dirs": listing["dirs"],
+                               "absent": [name for name in listing["absent"] if name not in fetched],
+                               "files": [entities(op.join(path, name)) for name in files]}
+            dirs[path] = listing
+            records.extend(listing["files"])
+            pending.extend(op.join(path, name) for name in reversed(listing["dirs"]))
+        self.dirs = dirs
+        return records
+
+    def select(self, **criteria):
+        """Records whose entities equal all `criteria`, e.g. suffix='bold'"""
+        return [record for record in self.records
+                if all(record.get(key) == value for key, value in criteria.items())]
+
+    def paths(self, **criteria):
+        """Paths of the selected records, carrying their entities"""
+        return [BIDSPath(record["path"], record) for record in self.select(**criteria)]
+
+
+def parse_selection(selections):
+    """Turn a list of key=value strings into a dict of criteria"""
+    criteria = {}
+    for selection in selections or []:
+        key, _, value = selection.partition('=')
+        criteria[key] = value
+    return criteria
+
+
+def dataset_files(root, cache=None, selections=None, extension=".json"):
+    """Paths of the files in dataset `root` matching `selections` (key=value strings)"""
+    criteria = dict({"extension": extension}, **parse_selection(selections))
+    return DatasetIndex(root, cache).paths(**criteria)
+
+
+def get_opt_parser():
+    p = OptionParser(usage="%prog [options] ROOT")
+
+    p.add_options([
+        Option("-c", "--cache",
+               dest="cache", default=None,
+               help="File to keep the directory listings in between runs"),
+
+        Option("-s", "--select",
+               dest="select", action="append", default=None,
+               help="Only list files with entity KEY=VALUE (e.g. suffix=bold, "
+                    "extension=.json, datatype=anat). Can be given multiple times"),
+
+        Option("-t", "--table",
+               dest="table", default=None,
+               help="Write the table of selected files and their entities to this CSV "
+                    "instead of listing the paths"),
+
+        Option("-0", "--null",
+               dest="null", action="store_true", default=False,
+               help="Separate listed paths by NUL instead of newline"),
+    ])
+
+    return p
+
+
+def main(args=None):
+    parser = get_opt_parser()
+
+    (options, roots) = parser.parse_args(args)
+    if len(roots) != 1:
+        parser.error("Specify exactly one dataset ROOT")
+
+    records = DatasetIndex(roots[0], options.cache).select(**parse_selection(options.select))
+    if options.table:
+        with open(options.table, "w") as destination:
+            product = csv.DictWriter(destination, columns, extrasaction='ignore')
+            product.writeheader()
+            product.writerows(records)
+    else:
+        end = '\0' if options.null else '\n'
+        for record in records:
+            sys.stdout.write(record["path"] + end)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,891 @@
+# Helpers shared by the process_*.py extraction scripts
+
+import os
+import os.path as op
+import csv
+import json
+import sys
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, reduce
+from itertools import islice
+from operator import getitem, itemgetter
+from multiprocessing import Pool
+from optparse import Option
+
+from bidsindex import dataset_files, entities
+
+try:
+    import orjson
+except ImportError: # optional, only makes decoding faster
+    orjson = None
+
+
+def seconds(input):
+    # HH:MM:SS[.ffffff] to seconds since midnight, fractions are dropped
+    hours, minutes, secs = input.split('.')[0].split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(secs)
+
+
+# conversions a field of a Spec can ask for with its "type"
+converters = {
+    "float": float,
+    "int": int,
+    "str": str,
+    "seconds": seconds,
+}
+
+_lookup_errors = (KeyError, IndexError, TypeError)
+
+
+class MissingField(KeyError):
+    """A required field of a Spec is in none of its locations"""
+
+
+def _lookup(path, d):
+    return reduce(getitem, path, d)
+
+
+def _accessor(path):
+    # a direct lookup such as d['bids_meta']['ShimSetting'][0]
+    if len(path) == 1:
+        return itemgetter(path[0])
+    return partial(_lookup, tuple(path))
+
+
+class Spec(object):
+    """Compiled declarative specification of the fields of a row
+
+    Parameters
+    ----------
+    fields: list of dicts, one per column, with
+      name: the column name
+      path: list of keys (and list indices) leading to the value in the JSON
+      fallback: optional path where older (pre-2018) JSONs keep the value
+      type: optional name of the conversion to apply, see converters
+      default: value used when the field is in none of its locations. Fields
+        without a default are required
+
+    Accessors for the paths are built once, so extracting a row costs a
+    direct lookup per field. Specs pickle as their fields and are compiled
+    again when unpickled, so they can be handed to worker processes.
+    """
+
+    def __init__(self, fields):
+        self.fields = [dict(field) for field in fields]
+        self.names = [field["name"] for field in self.fields]
+        self._compiled = [
+            (field["name"],
+             [_accessor(path) for path in (field["path"], field.get("fallback")) if path],
+             converters[field["type"]] if field.get("type") else None,
+             "default" not in field,
+             field.get("default"))
+            for field in self.fields
+        ]
+
+    def digest(self):
+        """Short hash of the fields, e.g. to invalidate rows cached with other ones"""
+        return hashlib.sha1(json.dumps(self.fields, sort_keys=True).encode()).hexdigest()[:12]
+
+    def __getstate__(self):
+        return self.fields
+
+    def __setstate__(self, fields):
+        self.__init__(fields)
+
+    def __call__(self, loaded):
+        """Values of all fields in `loaded`, raising MissingField for a missing required one"""
+        values = []
+        for name, getters, convert, required, default in self._compiled:
+            for get in getters:
+                try:
+                    value = get(loaded)
+                    break
+                except _lookup_errors:
+                    pass
+            else:
+                if required:
+                    raise MissingField(name)
+                values.append(default)
+                continue
+            values.append(value if convert is None or value is None else convert(value))
+        return values
+
+
+def metric_row(spec, sid, item, loaded):
+    """Row of the mriqc JSON `item`: its date, subject and session, Filetype and the fields of `spec`
+
+    `sid` formats the subject entity into the sid column, None leaves out
+    the sid and ses columns (e.g. for QA sessions). The spec knows where
+    2018 and later and pre 2018 JSONs keep the fields; a missing field
+    raises MissingField, and produce_rows skips the file.
+    """
+    info = entities(item)
+    values = spec(loaded)
+    if sid is None:
+        return [info["date"], info["Filetype"]] + values
+    return [info["date"], sid(info["sub"]), info["ses"], info["Filetype"]] + values
+
+
+def load_spec(path):
+    """Read a Spec from a JSON file with the list of its fields"""
+    with open(path) as f:
+        return Spec(json.load(f))
+
+
+# types of the columns of extractions, by name or by name prefix, which columnar outputs are written with
+# and nuisancelib.read_extraction loads every format with.
+# Columns not listed are stored as numbers when all their values are numeric
+column_types = {
+    "Date": "date",
+    "AcquisitionTime": "seconds",
+    "Filetype": "category",
+    "sid": "category",
+    "ses": "category",
+    "SoftwareVersions": "category",
+    "CSV": "category",
+}
+column_prefix_types = {
+    "Shim": "float32",
+    "IOPD": "float32",
+}
+formats = {".csv": "csv", ".parquet": "parquet", ".feather": "feather"}
+
+
+def output_format(output, fmt=None):
+    """Format to write `output` in, `fmt` or the one its extension implies"""
+    return fmt or formats.get(op.splitext(output)[1].lower(), "csv")
+
+
+def column_type(column):
+    if column in column_types:
+        return column_types[column]
+    for prefix, type_ in column_prefix_types.items():
+        if column.startswith(prefix):
+            return type_
+    return None
+
+
+def typed_frame(frame):
+    """Convert columns of extraction DataFrame `frame` to their schema types"""
+    import pandas as pd
+    for column in frame.columns:
+        type_ = column_type(column)
+        values = frame[column]
+        if type_ == "date":
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                frame[column] = pd.to_datetime(values.astype(str), format="%Y%m%d")
+        elif type_ == "seconds":
+            if values.dtype == object and values.astype(str).str.contains(":").any():
+                # HH:MM:SS[.ffffff] to seconds since midnight, fractions are dropped as by `seconds`
+                values = pd.to_timedelta(values.astype(str).str.split(".").str[0]).dt.total_seconds()
+                if not values.hasnans:
+                    values = values.astype("int64")
+            frame[column] = pd.to_numeric(values)
+        elif type_ == "category":
+            if not pd.api.types.is_categorical_dtype(values):
+                # missing values stay missing rather than becoming a 'nan' category
+                frame[column] = values.astype(str).where(values.notna()).astype("category")
+        elif type_ is not None:
+            frame[column] = pd.to_numeric(values).astype(type_)
+        elif values.dtype == object:
+            try:
+                frame[column] = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                # e.g. multi-valued DICOM fields, kept as written in CSVs
+                frame[column] = values.map(lambda v: v if v is None or isinstance(v, str) else str(v))
+    return frame
+
+
+class CSVOutput(object):
+    def __init__(self, output, header, append=True):
+        new = not append or not op.exists(output) or op.getsize(output) == 0
+        self.destination = open(output, "a" if append else "w")
+        self.product = csv.writer(self.destination)
+        if new:
+            self.product.writerow(header)
+
+    def writerow(self, row):
+        self.product.writerow(row)
+
+    def close(self):
+        self.destination.close()
+
+
+class ColumnarOutput(object):
+    """Collects rows and writes them as a typed Parquet or Feather table"""
+
+    def __init__(self, output, header, append=True, fmt="parquet"):
+        try:
+            import pandas
+            import pyarrow
+        except ImportError as exc:
+            raise ImportError("Writing %s output requires pandas and pyarrow: %s" % (fmt, exc))
+        self.output = output
+        self.header = header
+        self.append = append
+        self.fmt = fmt
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+    def close(self):
+        import pandas as pd
+        frame = typed_frame(pd.DataFrame(self.rows, columns=self.header))
+        if self.append and op.exists(self.output):
+            # the stored columns are typed already, the new rows have to be as well to be concatenated
+            read = pd.read_parquet if self.fmt == "parquet" else pd.read_feather
+            frame = typed_frame(pd.concat([read(self.output), frame], ignore_index=True))
+        if self.fmt == "parquet":
+            frame.to_parquet(self.output, index=False)
+        else:
+            frame.to_feather(self.output)
+
+
+class ProfiledOutput(object):
+    """Output counting the rows written and timing it as the "write" stage of a Profile"""
+
+    def __init__(self, output, profile):
+        self.output = output
+        self.profile = profile
+
+    def writerow(self, row):
+        start = time.perf_counter()
+        self.output.writerow(row)
+        self.profile.add("write", time.perf_counter() - start)
+        self.profile.count("rows")
+
+    def close(self):
+        with self.profile.timer("write"):
+            self.output.close()
+
+
+def open_output(output, header, append=True, fmt=None, profile=None):
+    """Open `output` for writing rows with columns `header`
+
+    Returns an object with writerow() and close(). CSVs are written row by
+    row, with the header only when the file is created or truncated, so
+    appending to an existing extraction does not repeat it. Parquet and
+    Feather outputs are written at close() with the types of column_types.
+    With a Profile the rows and the time spent writing are recorded.
+    """
+    fmt = output_format(output, fmt)
+    if fmt == "csv":
+        output = CSVOutput(output, header, append)
+    else:
+        output = ColumnarOutput(output, header, append, fmt)
+    return ProfiledOutput(output, profile) if profile is not None else output
+
+
+def write_records(records, output, header, append=True, fmt=None, profile=None):
+    """Write the values of `header` in every record (dict) of `records` to `output`
+
+    The sink of the extraction generators, see open_output for the other
+    parameters. Columns a record does not have are left empty. Returns the
+    number of records written.
+    """
+    destination = open_output(output, header, append, fmt, profile)
+    n = 0
+    try:
+        for record in records:
+            destination.writerow([record.get(column) for column in header])
+            n += 1
+    finally:
+        destination.close()
+    return n
+
+
+def read_paths(stream, null=False):
+    """Yield the paths listed in binary `stream`, one per line or NUL separated
+
+    NUL separated lists are what `find -print0` writes, and allow any
+    character in names. Empty entries are skipped.
+    """
+    separator = b"\0" if null else b"\n"
+    rest = b""
+    for chunk in iter(partial(stream.read, 1 << 16), b""):
+        entries = (rest + chunk).split(separator)
+        rest = entries.pop()
+        for entry in entries:
+            if not null:
+                entry = entry.rstrip(b"\r")
+            if entry:
+                yield os.fsdecode(entry)
+    if rest:
+        yield os.fsdecode(rest if null else rest.rstrip(b"\r"))
+
+
+def _paths(args, null, stdin, files):
+    for arg in args:
+        if arg == "-":
+            yield from read_paths(stdin or sys.stdin.buffer, null)
+        else:
+            yield arg
+    yield from files
+
+
+def input_paths(args, null=False, stdin=None, files=()):
+    """Paths of `args` followed by `files`, with "-" standing for the paths read from stdin
+
+    Without "-" a list is returned, otherwise a generator reading stdin as
+    it is consumed (see read_paths for `null`), so long lists from `find`
+    are never held in memory.
+    """
+    if "-" not in args:
+        return list(args) + list(files)
+    return _paths(args, null, stdin, files)
+
+
+def add_extraction_options(parser, json_files=True, items="files"):
+    """Add the options the extraction scripts share to optparse `parser`
+
+    These are -0, --format, --read-ahead, --read-ahead-mb and --profile,
+    and with `json_files` (default) those of the scripts extracting JSON
+    files: --dataset, --select, --dataset-cache, --jobs, --manifest and
+    --json-backend. `items` names what the script reads in the help.
+    See option_paths and read_ahead_options to use them.
+    """
+    if json_files:
+        parser.add_options([
+            Option("-d", "--dataset",
+                   dest="dataset", default=None,
+                   help="Root of a BIDS dataset (or derivatives) to take the JSON files from, "
+                        "in addition to the files given as arguments"),
+
+            Option("--select",
+                   dest="select", action="append", default=None,
+                   help="With --dataset, only take files with entity KEY=VALUE (e.g. suffix=bold, "
+                        "acq=p2, datatype=anat). Can be given multiple times"),
+
+            Option("--dataset-cache",
+                   dest="dataset_cache", default=None,
+                   help="With --dataset, file to keep directory listings in so rescans only "
+                        "list directories which changed"),
+        ])
+
+    parser.add_option(
+        "-0", "--null",
+        dest="null", action="store_true", default=False,
+        help="Paths read from stdin (given as '-') are separated by NUL characters, "
+             "as written by find -print0, instead of newlines")
+
+    if json_files:
+        parser.add_options([
+            Option("-j", "--jobs",
+                   dest="jobs", type="int", default=1,
+                   help="Number of processes to parse JSON files with (0 to use all cores)"),
+
+            Option("-m", "--manifest",
+                   dest="manifest", default=None,
+                   help="Manifest file caching the rows already extracted. Only new or "
+                        "changed files get parsed and the output is rewritten with all rows"),
+
+            Option("--json-backend",
+                   dest="json_backend", default="auto", type="choice", choices=["auto", "json", "orjson"],
+                   help="JSON parser to use. 'auto' (default) uses orjson if it is installed"),
+        ])
+
+    parser.add_options([
+        Option("-F", "--format",
+               dest="format", default=None, type="choice", choices=["csv", "parquet", "feather"],
+               help="Output format, by default taken from the extension of the output "
+                    "(.parquet, .feather) or csv. Columnar formats store typed columns"),
+
+        Option("--read-ahead",
+               dest="read_ahead", type="int", default=0,
+               help="Number of threads reading %s ahead of the parsing, for storage where "
+                    "opening files is slow (e.g. annexed files on a network file system). "
+                    "0 (default) reads %s when they are parsed" % (items, items)),
+
+        Option("--read-ahead-mb",
+               dest="read_ahead_mb", type="float", default=64,
+               help="With --read-ahead, most megabytes read ahead at once [default: %default]"),
+
+        Option("--profile",
+               dest="profile", default=None,
+               help="Write a JSON report of the time spent in every stage (reading, parsing, "
+                    "writing...) and of the %s, bytes and rows processed" % items),
+    ])
+
+
+def read_ahead_options(options):
+    """The read_ahead and read_ahead_bytes arguments of produce_rows given by `options`"""
+    return {"read_ahead": options.read_ahead, "read_ahead_bytes": int(options.read_ahead_mb * 2**20)}
+
+
+def option_paths(options, args, profile):
+    """Paths to extract: those of `args` (see input_paths), then the files of --dataset"""
+    files = []
+    if options.dataset:
+        with profile.timer("walk"):
+            files = dataset_files(options.dataset, options.dataset_cache, options.select)
+    return input_paths(args, options.null, files=files)
+
+
+class Manifest(object):
+    """Persistent cache of rows extracted from files
+
+    For every file it records the size, modification time and sha256 of
+    the content along with the row extracted from it. A file whose size
+    and mtime did not change is not read again; if only its stat changed
+    (e.g. after `git annex get`) it is read but not parsed when the content
+    hash is still the same.
+
+    Parameters
+    ----------
+    path: where the manifest is stored (JSON)
+    tag: identifies what kind of rows are cached. A manifest written for a
+      different tag is ignored and started from scratch
+    """
+
+    def __init__(self, path, tag):
+        self.path = path
+        self.tag = tag
+        self.files = {}
+        if op.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored.get("tag") == tag:
+                self.files = stored["files"]
+            else:
+                print("Manifest %s was written for %r, not %r. Starting afresh"
+                      % (path, stored.get("tag"), tag))
+
+    @staticmethod
+    def key(item):
+        return op.abspath(os.fsdecode(item))
+
+    def lookup(self, item):
+        """Return (entry, fresh) for `item`
+
+        `fresh` is True if the file's size and mtime match the recorded
+        ones so the cached row can be used as is.
+        """
+        entry = self.files.get(self.key(item))
+        if entry is None:
+            return None, False
+        try:
+            st = os.stat(os.fsdecode(item))
+        except OSError:  # reading it will tell why
+            return entry, False
+        return entry, (st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime"])
+
+    def update(self, item, entry):
+        self.files[self.key(item)] = entry
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"tag": self.tag, "files": self.files}, f)
+        os.replace(tmp, self.path)
+
+
+class Profile(object):
+    """Timers and counters of the stages of an extraction
+
+    Stages are timed with `timer` (or `add` for durations measured
+    elsewhere, e.g. by workers), counters count files, bytes, rows...
+    and `skip` counts files left out by reason. `report` gives all of it,
+    with files and bytes per second, as a dict which `save` writes as JSON.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.timers = {}
+        self.counters = {}
+        self.skipped = {}
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.timers[stage] = self.timers.get(stage, 0.0) + seconds
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def skip(self, reason):
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rates = {}
+        if elapsed > 0:
+            for counter in ("files", "bytes", "rows"):
+                if counter in self.counters:
+                    rates[counter + "_per_second"] = self.counters[counter] / elapsed
+        return {"name": self.name, "elapsed": elapsed, "timers": self.timers,
+                "counters": self.counters, "rates": rates, "skipped": self.skipped}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+
+class Progress(object):
+    """Progress line on stderr, updated at most every `interval` seconds
+
+    On a terminal the line is rewritten in place, otherwise a new line is
+    written at each update.
+    """
+
+    def __init__(self, total=None, interval=1.0, stream=None, unit="files"):
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.unit = unit
+        self.tty = self.stream.isatty()
+        self.done = 0
+        self.started = self.shown = time.perf_counter()
+        self.written = False
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.shown >= self.interval:
+            self.shown = now
+            self.show(now)
+
+    def show(self, now):
+        rate = self.done / max(now - self.started, 1e-9)
+        line = "%d%s %s, %.0f %s/s" % (self.done, "/%d" % self.total if self.total else "",
+                                      self.unit, rate, self.unit)
+        self.stream.write(("\r%s" if self.tty else "%s\n") % line)
+        self.stream.flush()
+        self.written = True
+
+    def close(self):
+        # the final count, if any progress was shown at all
+        if self.written:
+            self.show(time.perf_counter())
+            if self.tty:
+                self.stream.write("\n")
+
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # e.g. NaN, which json.dump writes but orjson does not accept
+        return json.loads(data)
+
+
+def _select(loads, keys, data):
+    return {key: value for key, value in loads(data).items() if key in keys}
+
+
+json_backends = ["auto", "json", "orjson"]
+
+
+def json_decoder(backend="auto", keys=None):
+    """Return a function decoding JSON documents (bytes or str)
+
+    Parameters
+    ----------
+    backend: "json" for the standard library, "orjson" for the (much faster)
+      orjson package, or "auto" to use orjson when it is installed
+    keys: optional collection of top level keys to keep. The whole document
+      is still parsed, the other keys are only filtered out of the result.
+      That is worth it when the decoded object is kept, e.g. by segstats_row
+      whose rows (cached in manifests) hold the labels, not when a Spec picks
+      its fields and drops the object right away
+    """
+    if backend in (None, "auto"):
+        backend = "orjson" if orjson is not None else "json"
+    if backend == "orjson":
+        if orjson is None:
+            raise ImportError("JSON backend orjson was requested but is not installed")
+        loads = _orjson_loads
+    elif backend == "json":
+        loads = json.loads
+    else:
+        raise ValueError("Unknown JSON backend %r, use one of %s" % (backend, ", ".join(json_backends)))
+    if keys is None:
+        return loads
+    return partial(_select, loads, frozenset(keys))
+
+
+def read_file(item):
+    """(os.stat_result, bytes) of the file `item`"""
+    with open(os.fsdecode(item), "rb") as f:
+        return os.fstat(f.fileno()), f.read()
+
+
+class LatentReader(object):
+    """Reader waiting `latency` seconds before every read by `read`
+
+    Stands in for storage where opening a file is slow (e.g. annexed files
+    on a network file system), to benchmark read-ahead on a local disk.
+    """
+
+    def __init__(self, latency, read=read_file):
+        self.latency = latency
+        self.read = read
+
+    def __call__(self, item):
+        time.sleep(self.latency)
+        return self.read(item)
+
+
+def _timed(read, *args):
+    start = time.perf_counter()
+    result = read(*args)
+    return result, time.perf_counter() - start
+
+
+def _buffered(pending, size):
+    # bytes read ahead and not consumed yet
+    return sum(size(future.result()[0]) for _, future in pending
+               if future.done() and future.exception() is None and future.result()[0] is not None)
+
+
+def prefetch(items, read=read_file, threads=8, max_bytes=64 << 20, size=len, profile=None, stage="read"):
+    """Yield (item, read(item)) for `items`, reading ahead on a pool of threads
+
+    While the caller works on an item, the following ones are read by up to
+    `threads` threads, so the latency of opening files on network or annexed
+    storage is hidden behind the parsing. At most 4 * `threads` items are
+    read ahead, and no read is started while the results waiting to be
+    consumed take more than `max_bytes` (as measured by `size`; `read` can
+    return None for items which need no reading). Results come in the order
+    of `items`, and an exception raised by a read is raised when its item is
+    reached. `items` is iterated in the calling thread. With 0 threads every
+    item is read when it is reached.
+
+    With a Profile the time spent reading (summed over threads) is added to
+    `stage`, and the time the caller waited for reads to "`stage`_wait".
+    """
+    if profile is None:
+        profile = Profile("prefetch")
+    if not threads:
+        for item in items:
+            result, seconds = _timed(read, item)
+            profile.add(stage, seconds)
+            yield item, result
+        return
+    items = iter(items)
+    pending = deque()
+    exhausted = False
+    executor = ThreadPoolExecutor(threads)
+    try:
+        while True:
+            while not exhausted and len(pending) < 4 * threads and _buffered(pending, size) < max_bytes:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    pending.append((item, executor.submit(_timed, read, item)))
+            if not pending:
+                break
+            item, future = pending.popleft()
+            start = time.perf_counter()
+            result, seconds = future.result()
+            profile.add(stage + "_wait", time.perf_counter() - start)
+            profile.add(stage, seconds)
+            yield item, result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _data_size(read):
+    return 0 if isinstance(read, OSError) else len(read[1])
+
+
+def _read_or_error(reader, item):
+    try:
+        return reader(item)
+    except OSError as exc:
+        return exc
+
+
+def _produce_entry(args):
+    # the timings of the stages go back to the main process along with the row.
+    # `read` is the (stat, data) of the file, or the OSError reading it, when it was read ahead
+    producer, item, hashed, cached, decode, reader, read = args
+    stats = {}
+    if read is None:
+        read, stats["read"] = _timed(_read_or_error, reader, item)
+    if isinstance(read, OSError):
+        # e.g. removed since it was listed, or an annexed file whose content is not present
+        return {"size": 0, "stats": stats, "row": None, "unreadable": True,
+                "skipped": "%s cannot be read (%s)." % (os.fsdecode(item), read.strerror)}
+    st, data = read
+    entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "stats": stats}
+    if hashed:
+        start = time.perf_counter()
+        entry["sha256"] = hashlib.sha256(data).hexdigest()
+        stats["hash"] = time.perf_counter() - start
+        if cached is not None and cached["sha256"] == entry["sha256"]:
+            entry["row"] = cached["row"]
+            if "skipped" in cached:
+                entry["skipped"] = cached["skipped"]
+            return entry
+    start = time.perf_counter()
+    try:
+        loaded = decode(data)
+    except ValueError as exc:
+        # e.g. a JSON still being written, or truncated by a crash. Not recorded in the
+        # manifest, so it is parsed again once it is complete
+        entry.update(row=None, unreadable=True,
+                     skipped="%s cannot be decoded (%s)." % (os.fsdecode(item), exc))
+        return entry
+    stats["decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    try:
+        entry["row"] = producer(item, loaded)
+    except MissingField as exc:
+        entry["row"] = None
+        entry["skipped"] = "%s is not present." % exc
+    stats["extract"] = time.perf_counter() - start
+    return entry
+
+
+def produce_rows(producer, source, jobs=1, manifest=None, decoder=None, chunksize=16, profile=None,
+                 read_ahead=0, read_ahead_bytes=64 << 20, reader=read_file):
+    """Yield `producer(item, loaded_json)` for every item in `source`
+
+    Parameters
+    ----------
+    producer: callable(item, loaded) returning a row (list), or None (or
+      raising MissingField) to skip the file. When jobs > 1 it must be
+      picklable (e.g. a module level function or a partial of one). Files
+      which cannot be read or decoded are skipped as well, and are left
+      out of the manifest so they are tried again
+    source: iterable of paths to JSON files
+    jobs: number of worker processes to parse files with. 1 (default) parses
+      in the current process, 0 or None uses all available cores
+    manifest: optional Manifest. Rows of files which did not change since
+      they were recorded are taken from it, and it is saved at the end
+    decoder: function decoding the content of a file, see json_decoder.
+      By default the fastest available JSON backend
+    chunksize: how many files to hand to a worker at once
+    profile: optional Profile getting the time spent reading, hashing,
+      decoding and extracting (summed over workers), and counts of files,
+      bytes, cached rows and skipped files
+    read_ahead: number of threads reading files ahead of the parsing (see
+      prefetch), for storage where opening files is slow. 0 (default) has
+      every file read by the process parsing it
+    read_ahead_bytes: how much data can be read ahead, on top of the batch
+      of files being parsed
+    reader: function returning (os.stat_result, bytes) of a path, see
+      read_file and LatentReader
+
+    Rows are yielded in the order of `source` regardless of `jobs`, so the
+    output does not depend on how many workers were used. Progress is shown
+    on stderr, and why files were skipped is printed.
+    """
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    if decoder is None:
+        decoder = json_decoder()
+    if profile is None:
+        profile = Profile("produce_rows")
+    progress = Progress(len(source) if hasattr(source, "__len__") else None)
+
+    def lookups():
+        for item in source:
+            with profile.timer("manifest"):
+                cached, fresh = manifest.lookup(item) if manifest else (None, False)
+            yield item, cached, fresh
+
+    def read_changed(looked_up):
+        item, _, fresh = looked_up
+        return None if fresh else _read_or_error(reader, item)
+
+    if read_ahead:
+        files = prefetch(lookups(), read_changed, read_ahead, read_ahead_bytes, _data_size, profile)
+    else:
+        files = ((looked_up, None) for looked_up in lookups())
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        while True:
+            batch = list(islice(files, max(256, 4 * jobs * chunksize)))
+            if not batch:
+                break
+            entries = [None] * len(batch)
+            tasks = []
+            for i, ((item, cached, fresh), read) in enumerate(batch):
+                if fresh:
+                    entries[i] = cached
+                    profile.count("cached")
+                else:
+                    tasks.append((i, (producer, item, manifest is not None, cached, decoder, reader, read)))
+            args = [task for _, task in tasks]
+            results = pool.imap(_produce_entry, args, chunksize) if pool else map(_produce_entry, args)
+            for (i, _), entry in zip(tasks, results):
+                for stage, seconds in entry.pop("stats").items():
+                    profile.add(stage, seconds)
+                profile.count("bytes", entry["size"])
+                entries[i] = entry
+                if manifest and not entry.get("unreadable"):
+                    manifest.update(batch[i][0][0], entry)
+            for entry in entries:
+                profile.count("files")
+                progress.update()
+                if entry.get("skipped"):
+                    print(entry["skipped"])
+                    profile.skip(entry["skipped"])
+                yield entry["row"]
+    finally:
+        if pool:
+            pool.terminate()
+        files.close()
+        progress.close()
+    if manifest:
+        with profile.timer("manifest"):
+            manifest.save()
+
+
+def metric_header(spec, sid=None):
+    """Columns of the rows metric_row gives for `spec` and `sid`"""
+    if sid is None:
+        return ["Date", "Filetype"] + spec.names
+    return ["Date", "sid", "ses", "Filetype"] + spec.names
+
+
+def metric_records(fields, sid, tag, source, jobs=1, manifest=None, spec=None, json_backend="auto", profile=None,
+                   read_ahead=0, read_ahead_bytes=64 << 20):
+    """Yield a record (dict keyed by the columns of metric_header) for every mriqc JSON in `source`
+
+    `source` can be any iterable of paths, e.g. a generator, and is consumed
+    as the records are. The fields of `spec` (by default Spec(fields)) are
+    extracted, and files missing a required one are skipped. `sid` is as
+    for metric_row, and `tag` tells the extraction apart in the manifest,
+    whose path `manifest` is. See produce_rows for the other parameters.
+    The extraction scripts give the first three, e.g. as
+    process_QA_metrics.qa_metric_records.
+    """
+    spec = spec or Spec(fields)
+    if manifest is not None:
+        manifest = Manifest(manifest, "%s %s" % (tag, spec.digest()))
+
+    header = metric_header(spec, sid)
+    for row in produce_rows(partial(metric_row, spec, sid), source, jobs, manifest,
+                            json_decoder(json_backend), profile=profile,
+                            read_ahead=read_ahead, read_ahead_bytes=read_ahead_bytes):
+        if row is not None:
+            yield dict(zip(header, row))
+
+
+def metric_producer(fields, sid, tag, source, output_csv, jobs=1, manifest=None, fmt=None, spec=None,
+                    json_backend="auto", profile=None, read_ahead=0, read_ahead_bytes=64 << 20):
+    """Write the records of metric_records to `output_csv`, in format `fmt` (see write_records)"""
+    # a CSV gets the header row if it is a new one.
+    # With a manifest all rows are produced again, so the file is rewritten
+    spec = spec or Spec(fields)
+    write_records(metric_records(fields, sid, tag, source, jobs, manifest, spec, json_backend, profile,
+                                 read_ahead, read_ahead_bytes),
+                  output_csv, metric_header(spec, sid), append=manifest is None, fmt=fmt, profile=profile)
@@ -14,6 +14,14 @@ import time
 import sys
 from optparse import OptionParser, Option
 from glob import glob
+from functools import partial
+
+from extractlib import (Profile, Spec, add_extraction_options, input_paths, load_spec, metric_header,
+                        metric_producer, metric_records, option_paths, output_format, read_ahead_options,
+                        write_records)
+import specs
+import watchlib
+from bidsindex import dataset_files, entities, parse_selection
 
 # FILE PATHS TO BE ESTABLISHED
 bids_subject = 'qa'
@@ -25,7 +33,7 @@ ses_path = op.join(bids_ds_path, 'sub-qa', 'ses-*')
 
 def get_opt_parser():
     # use module docstring for help output
-    p = OptionParser()
+    p = OptionParser(usage="%prog [options] [FILE|-]...")
 
     p.add_options([
         Option("-o", "--output",
@@ -37,129 +45,163 @@ def get_opt_parser():
                dest="type", default="func",
                help="Is the final an anat or func?"),
 
+        Option("-s", "--spec",
+               dest="spec", default=None,
+               help="JSON file with the list of fields to extract, instead of the "
+                    "default ones for the --type (see specs.py)"),
+
+        Option("-w", "--watch",
+               dest="watch", action="store_true", default=False,
+               help="After the extraction, keep watching --dataset and extract the JSON files "
+                    "which land or change in it: rows of new files are appended to the output, "
+                    "and it is rewritten when files extracted before change. Needs --manifest. "
+                    "Runs until interrupted"),
+
+        Option("--poll",
+               dest="poll", type="float", default=None,
+               help="With --watch, scan the dataset every POLL seconds instead of using inotify "
+                    "(needed on network file systems, where inotify misses changes made by "
+                    "other hosts, and to see annexed files once their content is fetched)"),
+
+        Option("--settle",
+               dest="settle", type="float", default=2.0,
+               help="With --watch, seconds without changes to wait for before extracting, so "
+                    "files are not read while being written [default: %default]"),
+
+        Option("--refit",
+               dest="refit", default=None,
+               help="With --watch, refit the QA drift model of nuisancelib after every update "
+                    "and write its summary, with the residual of the latest session, to this JSON file"),
+
+        Option("--refit-acq",
+               dest="refit_acq", default="x", type="choice", choices=["x", "p2"],
+               help="Acquisition of the func QA sessions to refit the drift model with, see "
+                    "nuisancelib.filter [default: %default]"),
+
     ])
+    add_extraction_options(p)
 
     return p
 
 
-def seconds(input):
-    x = time.strptime(input.split('.')[0],'%H:%M:%S')
-    return int(datetime.timedelta(hours = x.tm_hour, minutes = x.tm_min, seconds = x.tm_sec).total_seconds())
-
-
-def qa_metric_producer(source, output_csv):
-    
-    # opening destination CSV file
-    destination = open(output_csv, "a")
-
-    # fires up the CSV writer module
-    product = csv.writer(destination)
-    
-    # WRITES THE HEADER ROW for the CSV
-    product.writerow(["Date", "Filetype", "tsnr", "SAR", "AcquisitionTime", "TxRefAmp", "SoftwareVersions", "CSV", "RepetitionTime", 
-        "Shim1", "Shim2", "Shim3", "Shim4", "Shim5", "Shim6", "Shim7", "Shim8", "IOPD1", "IOPD2", "IOPD3", "IOPD4", "IOPD5", "IOPD6"])
-
-    for item in source:  # os.listdir(os.fsencode("derivatives")):          # for each 
-        info = re.search('.*/ses-(?P<date>[0-9]+)/.*', item).groupdict()
-       
-        # FUNC: abbreviations for easier access to certain dicts in the func/.json files
-        func_json = open(os.fsdecode(item), "r").read()  # open sesameeee
-        loaded_func = json.loads(func_json)
-        func_bids = loaded_func["bids_meta"]
-        shim = func_bids["ShimSetting"]
-        IOPD = func_bids["ImageOrientationPatientDICOM"]
-
-        # ANAT: modifying the func code to access the anatomical JSON
-#        if int(info["date"]) >= 20171030:
-#            anat_item = str(item)
-#            anat_item = anat_item[:34] + "anat" + anat_item[38:]
-#            anat_item = anat_item[:59] + "acq-MPRAGE_T1w.json"
-            
-#            print(anat_item)
-            
-#            anat_json = open(os.fsdecode(anat_item), "r").read()
-#            loaded_anat = json.loads(anat_json)
-
-        print(item); # debugging, indicator that a file's been processed
-
-        # 2018 and later conditions
-        if 'SAR' and "AcquisitionTime" and "TxRefAmp" in loaded_func:
-            product.writerow([info["date"],
-                os.fsdecode(item)[59:], loaded_func["tsnr"], loaded_func["SAR"],
-                seconds(loaded_func["AcquisitionTime"]), loaded_func["TxRefAmp"], func_bids["SoftwareVersions"],
-                func_bids["ConversionSoftwareVersion"], func_bids["RepetitionTime"], 
-                shim[0], shim[1], shim[2], shim[3], shim[4], shim[5], shim[6], shim[7], IOPD[0], IOPD[1], IOPD[2], IOPD[3], IOPD[4], IOPD[5]])
-
-        # pre 2018 conditions, DOESN'T have TxRefAmp and different location for the other parameters
-        else:
-            if 'tsnr' in loaded_func and 'SAR' and 'AcquisitionTime' and 'TxRefAmp' in func_bids:
-                content = [info["date"], os.fsdecode(item)[59:], loaded_func['tsnr'], func_bids["SAR"],
-                    seconds(func_bids["AcquisitionTime"]), func_bids['TxRefAmp'], func_bids["SoftwareVersions"],
-                    func_bids["ConversionSoftwareVersion"], func_bids["RepetitionTime"], 
-                    shim[0], shim[1], shim[2], shim[3], shim[4], shim[5], shim[6], shim[7],
-                    IOPD[0], IOPD[1], IOPD[2], IOPD[3], IOPD[4], IOPD[5]] 
-                
-                if int(info["date"]) < 20171030:
-                    product.writerow(content)
+# QA sessions have no sid and ses columns (see extractlib.metric_records)
+qa_metric_records = partial(metric_records, specs.func_fields, None, "process_QA_metrics func")
+anat_metric_records = partial(metric_records, specs.anat_fields, None, "process_QA_metrics anat")
+qa_metric_producer = partial(metric_producer, specs.func_fields, None, "process_QA_metrics func")
+anat_metric_producer = partial(metric_producer, specs.anat_fields, None, "process_QA_metrics anat")
+
+
+def selected(path, criteria):
+    record = entities(path)
+    return all(record.get(key) == value for key, value in criteria.items())
+
+
+def watch_dataset(records, header, root, output_csv, paths=(), selections=None, dataset_cache=None, fmt=None,
+                  poll=None, settle=2.0, on_update=None, profile=None, retry=60.0):
+    """Extract the JSON files of dataset `root`, then keep `output_csv` up to date as files land
+
+    Parameters
+    ----------
+    records: function returning the records of a list of paths, using a
+      manifest so files extracted before are not parsed again (e.g. a
+      partial of qa_metric_records)
+    header: columns of the output
+    paths: other files to extract along with the ones of the dataset
+    selections, dataset_cache: as for dataset_files
+    poll: seconds between scans of the dataset, which is watched with
+      inotify by default (see watchlib.watcher)
+    settle: seconds without changes to wait for before extracting
+    on_update: optional function called after every update of the output
+    retry: seconds after which a failed extraction is tried again, if no
+      change came meanwhile
+
+    Rows of new files are appended to the output. When files which were
+    extracted before change, the output is rewritten from the manifest
+    (parsing only the changed files) and replaced at once. A JSON which
+    cannot be decoded (e.g. still being written) is skipped until it
+    changes. When changes may have been missed or an extraction failed
+    (e.g. a full disk), the dataset is extracted again. If the
+    dataset cannot be watched with inotify any longer (e.g. no watch left
+    for a new directory) it is polled instead. Runs until interrupted.
+    """
+    if profile is None:
+        profile = Profile("watch_dataset")
+    criteria = dict({"extension": ".json"}, **parse_selection(selections))
+    fmt = output_format(output_csv, fmt)
+    # watching starts before the extraction, so files landing during it are not missed
+    watcher = watchlib.watcher(root, poll)
+
+    def extract_all():
+        with profile.timer("walk"):
+            files = list(paths) + dataset_files(root, dataset_cache, selections)
+        known.update(op.abspath(path) for path in files)
+        tmp = output_csv + ".tmp"
+        write_records(records(files), tmp, header, append=False, fmt=fmt, profile=profile)
+        os.replace(tmp, output_csv)
+
+    def next_changes(timeout):
+        nonlocal watcher
+        try:
+            return watchlib.settled_changes(watcher, settle, timeout)
+        except OSError as exc:
+            # e.g. fs.inotify.max_user_watches reached by a new directory
+            watcher.close()
+            interval = poll or 5.0
+            print("Cannot watch %s any longer (%s), polling every %g s instead" % (root, exc, interval),
+                  file=sys.stderr)
+            watcher = watchlib.PollingWatcher(root, interval)
+            return None
+
+    known = set()
+    rescan = True  # the whole dataset is extracted at first, and when changes may have been missed
+    try:
+        while True:
+            updated = False
+            try:
+                if rescan:
+                    extract_all()
+                    rescan, updated = False, True
                 else:
-                    product.writerow(content)
-            else:
-                print("tsnr, SAR or TxRefAmp are not present.")
-
-    destination.close()
-
-
-def anat_metric_producer(source, output_csv):
-    
-    # opening destination CSV file
-    destination = open(output_csv, "a")
-
-    # fires up the CSV writer module
-    product = csv.writer(destination)
-    
-    # WRITES THE HEADER ROW for the CSV
-    product.writerow(["Date", "Filetype", "snr_total", "SAR", "AcquisitionTime", "TxRefAmp", "SoftwareVersions", "CSV", "RepetitionTime", 
-        "Shim1", "Shim2", "Shim3", "Shim4", "Shim5", "Shim6", "Shim7", "Shim8", "IOPD1", "IOPD2", "IOPD3", "IOPD4", "IOPD5", "IOPD6"])
-
-    for item in source:  # os.listdir(os.fsencode("derivatives")):          # for each 
-        info = re.search('.*/ses-(?P<date>[0-9]+)/.*', item).groupdict()
-       
-        # FUNC: abbreviations for easier access to certain dicts in the func/.json files
-        func_json = open(os.fsdecode(item), "r").read()  # open sesameeee
-        loaded_func = json.loads(func_json)
-        func_bids = loaded_func["bids_meta"]
-        shim = func_bids["ShimSetting"]
-        IOPD = func_bids["ImageOrientationPatientDICOM"]
-
-        print(item); # debugging, indicator that a file's been processed
-
-        # 2018 and later conditions
-        if 'SAR' and "AcquisitionTime" and "TxRefAmp" in func_bids:
-            product.writerow([info["date"],
-                os.fsdecode(item)[59:], loaded_func["snr_total"], func_bids["SAR"],
-                seconds(func_bids["AcquisitionTime"]), func_bids["TxRefAmp"], func_bids["SoftwareVersions"],
-                func_bids["ConversionSoftwareVersion"], func_bids["RepetitionTime"], 
-                shim[0], shim[1], shim[2], shim[3], shim[4], shim[5], shim[6], shim[7],
-                IOPD[0], IOPD[1], IOPD[2], IOPD[3], IOPD[4], IOPD[5]])
-        
-        # pre 2018 conditions, DOESN'T have TxRefAmp and different location for the other parameters
-        else:
-            if 'snr_total' in loaded_func and 'SAR' and 'AcquisitionTime' and 'TxRefAmp' in func_bids:
-                content = [info["date"], os.fsdecode(item)[59:], func_bids['snr_total'], func_bids["SAR"],
-                    seconds(func_bids["AcquisitionTime"]), func_bids['TxRefAmp'], func_bids["SoftwareVersions"],
-                    func_bids["ConversionSoftwareVersion"], func_bids["RepetitionTime"], 
-                    shim[0], shim[1], shim[2], shim[3], shim[4], shim[5], shim[6], shim[7],
-                    IOPD[0], IOPD[1], IOPD[2], IOPD[3], IOPD[4], IOPD[5]] 
-                
-                if int(info["date"]) < 20171030:
-                    product.writerow(content)
-                else:
-                    content.append(loaded_anat["snr_total"])
-                    product.writerow(content)
-            else:
-                print("snr_total, SAR or TxRefAmp are not present.")
-
-    destination.close()
+                    changed = sorted(path for path in changed if selected(path, criteria) and op.isfile(path))
+                    if any(op.abspath(path) in known for path in changed):
+                        extract_all()
+                        print("%d file(s) changed, %s was rewritten" % (len(changed), output_csv), file=sys.stderr)
+                    elif changed:
+                        known.update(op.abspath(path) for path in changed)
+                        write_records(records(changed), output_csv, header, append=True, fmt=fmt, profile=profile)
+                        print("%d new file(s) added to %s" % (len(changed), output_csv), file=sys.stderr)
+                    updated = bool(changed)
+            except (OSError, ValueError) as exc:
+                rescan = True
+                print("Extraction failed, extracting %s again at the next change or in %g s: %s"
+                      % (output_csv, retry, exc), file=sys.stderr)
+            if updated and on_update is not None:
+                on_update()
+            changed = next_changes(retry if rescan else None)
+            if changed is None:
+                rescan = True
+                print("Changes were missed, extracting %s again" % output_csv, file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def refit_drift(output, report, target, option):
+    """Refit the QA drift model on extraction `output`, writing nuisancelib.drift_report to `report`"""
+    # nuisancelib is in ipy/, and is only imported when refitting
+    ipy_path = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'ipy')
+    if ipy_path not in sys.path:
+        sys.path.append(ipy_path)
+    import nuisancelib
+
+    drift = nuisancelib.drift_report(nuisancelib.read_extraction(output), target, option)
+    drift["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+    tmp = report + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(drift, f, indent=1)
+    os.replace(tmp, report)
+    return drift
 
 
 def main(args=None):
@@ -167,13 +209,54 @@ def main(args=None):
 
     (options, source) = parser.parse_args(args)
 
+    if options.watch and not (options.dataset and options.manifest and options.output_csv):
+        parser.error("--watch needs --dataset, --manifest and --output")
+
+    profile = Profile(op.basename(__file__))
+
+    spec = load_spec(options.spec) if options.spec else None
+
+    if options.watch and options.type in ("func", "anat"):
+        if options.type == "func":
+            spec = spec or Spec(specs.func_fields)
+            records, target, option = qa_metric_records, "tsnr", options.refit_acq
+        else:
+            spec = spec or Spec(specs.anat_fields)
+            records, target, option = anat_metric_records, "snr_total", None
+
+        def refit():
+            try:
+                drift = refit_drift(options.output_csv, options.refit, target, option)
+            except Exception as exc:  # e.g. too few sessions yet, the watch goes on
+                print("Refitting the drift model failed: %s" % exc, file=sys.stderr)
+            else:
+                print("Drift model refitted on %d sessions, residual of %s: %.3g"
+                      % (drift["sessions"], drift["latest"]["Date"], drift["latest"]["residual"]), file=sys.stderr)
+
+        watch_dataset(partial(records, jobs=options.jobs, manifest=options.manifest, spec=spec,
+                              json_backend=options.json_backend, profile=profile, **read_ahead_options(options)),
+                      metric_header(spec), options.dataset, options.output_csv, list(input_paths(source, options.null)),
+                      options.select, options.dataset_cache, options.format, options.poll, options.settle,
+                      refit if options.refit else None, profile)
+
+        if options.profile:
+            profile.save(options.profile)
+        return
+
+    source = option_paths(options, source, profile)
+
     if options.type == "func":
-        qa_metric_producer(source, options.output_csv)
+        qa_metric_producer(source, options.output_csv, options.jobs, options.manifest, options.format, spec,
+                           options.json_backend, profile, **read_ahead_options(options))
     elif options.type == "anat":
-        anat_metric_producer(source, options.output_csv)
+        anat_metric_producer(source, options.output_csv, options.jobs, options.manifest, options.format, spec,
+                             options.json_backend, profile, **read_ahead_options(options))
     else:
         print("TYPE provided MUST be either anat or func")
 
+    if options.profile:
+        profile.save(options.profile)
+
 
 if __name__ == '__main__':
     main()
@@ -11,11 +11,20 @@ import re
 import datetime
 import time
 import tarfile
+import io
+import gzip
+import bz2
+import lzma
+import hashlib
+import sqlite3
 
 import sys
 from optparse import OptionParser, Option
 from glob import glob
-import pydicom
+from functools import partial
+
+from extractlib import (Profile, Progress, add_extraction_options, input_paths, prefetch, read_ahead_options,
+                        write_records)
 
 # FILE PATHS TO BE ESTABLISHED
 bids_subject = 'qa'
@@ -27,7 +36,7 @@ ses_path = op.join(bids_ds_path, 'sub-qa', 'ses-*')
 
 def get_opt_parser():
     # use module docstring for help output
-    p = OptionParser()
+    p = OptionParser(usage="%prog [options] [FILE|-]...")
 
     p.add_options([
         Option("-o", "--output",
@@ -36,63 +45,422 @@ def get_opt_parser():
                help="Where do you want the extraction to be written to"),
 
         Option("-t", "--type",
-               dest="type", default=None,
-               help="Specify what DICOM metadata you want extracted."),
+               dest="type", action="append", default=None,
+               help="Specify what DICOM metadata you want extracted. Takes a comma "
+                    "separated list of attributes and can be given multiple times."),
+
+        Option("-f", "--fields",
+               dest="fields", default=None,
+               help="File listing DICOM attributes to extract, one per line "
+                    "(empty lines and lines starting with # are ignored)"),
+
+        Option("-i", "--index",
+               dest="index", default=None,
+               help="File to keep the name, offset and size of every member of each tarball in "
+                    "(see MemberIndex). Indexing a tarball reads it whole once; later reads of "
+                    "uncompressed tarballs seek straight to a member"),
+
+        Option("-c", "--header-cache",
+               dest="header_cache", default=None,
+               help="SQLite file to store all (non-pixel) header fields of every series "
+                    "in. Series already in it are not read again for any attribute"),
 
     ])
+    add_extraction_options(p, json_files=False, items="series")
 
     return p
 
 
-def extract_parameter(source, parameter, output_csv):
-    
-    # opening destination CSV file
-    destination = open(output_csv, "w")
-
-    # fires up the CSV writer module
-    product = csv.writer(destination)
-    
-    # WRITES THE HEADER ROW for the CSV
-    header = ["Date", "sid", "ses"]
-    header.append(parameter)
-    product.writerow(header)
-
-    for item in source:  # os.listdir(os.fsencode("derivatives")):          # for each
-        print(item)
-        info = re.search('.*?ses-(?P<date>[0-9]+).*', item).groupdict()
-        ses = re.search('.*?ses-(?P<ses>[\w]+)_.*', item).groupdict()       # getting session id
-        sid = re.search('.*?sid(?P<sid>[0-9]+)_.*', item).groupdict()      # getting subject id
-
-        # merging dicts for easy access
-        info.update(ses)
-        info.update(sid)
-
-        # FUNC: abbreviations for easier access to certain dicts in the func/.json files
-        if item.endswith('.dcm'):
-            item_to_read = item
-        else: # we assume it is a tarball and will read the first from it
-            dicoms = tarfile.open(item, 'r')
-            item_to_read = dicoms.extractfile(
-                    dicoms.getmembers()[0]
-            )
-
-        ds = pydicom.dcmread(item_to_read, stop_before_pixels=True)
-        value = getattr(ds, parameter)
-        
-        product.writerow([info["date"], "sub-sid" + info["sid"], info["ses"], value])
-        
-    destination.close()
+# magic bytes of the compressions tarfile supports, and how to open them
+compressions = {
+    b'\x1f\x8b': ('gz', gzip.open),
+    b'BZh': ('bz2', bz2.open),
+    b'\xfd7zXZ': ('xz', lzma.open),
+}
+openers = dict(compressions.values())
+
+
+def compression_of(tarball):
+    with open(tarball, 'rb') as f:
+        magic = f.read(6)
+    for prefix, (compression, _) in compressions.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def stream_first_member(tarball):
+    """Return (TarInfo, bytes) of the first regular file in `tarball`
+
+    The archive is read as a stream and reading stops right after that
+    member, so for compressed tarballs only its beginning gets decompressed
+    (unlike getmembers(), which walks the whole archive).
+    """
+    with tarfile.open(tarball, 'r|*') as dicoms:
+        for member in dicoms:
+            if member.isfile():
+                return member, dicoms.extractfile(member).read()
+    raise ValueError("%s contains no files" % tarball)
+
+
+def list_members(tarball):
+    """(name, offset of the data, size) of every regular file in `tarball`, in archive order
+
+    The whole archive is walked: uncompressed tarballs by seeking from
+    header to header, compressed ones by decompressing all of them.
+    """
+    with tarfile.open(tarball, 'r:*') as archive:
+        return [[member.name, member.offset_data, member.size]
+                for member in archive.getmembers() if member.isfile()]
+
+
+class MemberIndex(object):
+    """Persistent table of the members of tarballs
+
+    For every tarball it records the name, position and size of every
+    regular file within the (decompressed) archive, so any member can be
+    read with a seek instead of walking the archive. Only uncompressed
+    tarballs get random access this way: a gzip, bzip2 or xz stream still
+    has to be decompressed up to the member, the index only spares parsing
+    the tar headers before it. Indexing a tarball walks it whole once (see
+    list_members), and entries are invalidated when the size or mtime of
+    the tarball change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tarballs = {}
+        self.changed = False
+        if op.exists(path):
+            with open(path) as f:
+                # indexes written before every member was listed are rebuilt
+                self.tarballs = {key: entry for key, entry in json.load(f).items() if 'members' in entry}
+
+    def entry(self, tarball):
+        key = op.abspath(tarball)
+        st = os.stat(tarball)
+        entry = self.tarballs.get(key)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime_ns:
+            entry = self.tarballs[key] = {
+                'size': st.st_size, 'mtime': st.st_mtime_ns,
+                'compression': compression_of(tarball), 'members': list_members(tarball),
+            }
+            self.changed = True
+        return entry
+
+    def members(self, tarball):
+        """Names of the regular files in `tarball`"""
+        return [name for name, _, _ in self.entry(tarball)['members']]
+
+    def read_member(self, tarball, name=None):
+        """Bytes of member `name` of `tarball`, the first regular file by default"""
+        entry = self.entry(tarball)
+        members = entry['members'] if name is None else [m for m in entry['members'] if m[0] == name]
+        if not members:
+            raise KeyError("%s has no member %s" % (tarball, name) if name else "%s contains no files" % tarball)
+        _, offset, size = members[0]
+        with openers.get(entry['compression'], open)(tarball, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def read_first_member(self, tarball):
+        return self.read_member(tarball)
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.tarballs, f)
+        os.replace(tmp, self.path)
+
+
+def read_first_member(tarball, index=None):
+    """Bytes of the first file in `tarball`, through `index` if given"""
+    if index is not None:
+        return index.read_first_member(tarball)
+    return stream_first_member(tarball)[1]
+
+
+# git-annex keys, e.g. MD5E-s19528--ae22854e079bd7b932425392c142f960.tar.gz
+annex_key_regex = re.compile(r'^[A-Z0-9]+-s[0-9]+(-[a-zA-Z0-9]+)*--[^/]+$')
+
+
+def annex_key(path):
+    """git-annex key of `path` if it is an annexed file, otherwise None
+
+    Annexed files are symlinks to an object named by its key, which already
+    contains the checksum of the content, so the file is not read.
+    """
+    target = op.basename(op.realpath(path))
+    return target if annex_key_regex.match(target) else None
+
+
+def header_key(data):
+    """Identify the header of a series by the digest of `data`, the bytes it is parsed from"""
+    return 'SHA256-s%d--%s' % (len(data), hashlib.sha256(data).hexdigest())
+
+
+def json_value(value):
+    """Convert a pydicom value into something JSON can store"""
+    import pydicom
+    if isinstance(value, pydicom.sequence.Sequence):
+        return [header_record(item) for item in value]
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        return [json_value(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return None
+    if isinstance(value, float): # also DSfloat
+        return float(value)
+    if isinstance(value, int): # also IS
+        return int(value)
+    if value is None:
+        return None
+    return str(value)
+
+
+def header_record(ds):
+    """All non-pixel data elements of `ds` as a dict keyed by keyword
+
+    Elements without a keyword (private tags) are keyed by their tag,
+    and binary values are not kept.
+    """
+    import pydicom
+    record = {}
+    for elem in ds:
+        if elem.tag == pydicom.tag.Tag('PixelData'):
+            continue
+        value = json_value(elem.value)
+        if value is not None:
+            record[elem.keyword or '%08X' % elem.tag] = value
+    return record
+
+
+class HeaderStore(object):
+    """SQLite store of header records, one per series
+
+    Records are keyed by the path, size and mtime of the series and by a
+    content key: the git-annex key of annexed series, otherwise the digest
+    of the bytes the header is parsed from (see header_key). A series which
+    was not modified is served without opening it, an annexed one which was
+    moved or re-checked-out too, and other moved ones only need their
+    header read (which can happen off the main thread) but not parsed.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS headers "
+                        "(path TEXT PRIMARY KEY, key TEXT, size INTEGER, mtime INTEGER, record TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS headers_key ON headers (key)")
+        self.keys = {}
+
+    def get(self, item):
+        """Return the cached record of `item`, or None if it has to be read
+
+        Only the path, size and mtime of `item` and its annex key are looked
+        up, nothing is read from it.
+        """
+        path = op.abspath(item)
+        st = os.stat(item)
+        row = self.db.execute("SELECT size, mtime, record FROM headers WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return json.loads(row[2])
+
+        key = annex_key(item)
+        if key is None:
+            return None
+        self.keys[path] = key
+        return self.find(item, key)
+
+    def find(self, item, key):
+        """Return the record stored for content `key`, recording it for `item` as well, or None
+
+        The record is kept under the annex key of `item` if it has one.
+        """
+        row = self.db.execute("SELECT record FROM headers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = op.abspath(item)
+        st = os.stat(item)
+        self.db.execute("REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+                        (path, self.keys.pop(path, None) or key, st.st_size, st.st_mtime_ns, row[0]))
+        return json.loads(row[0])
+
+    def put(self, item, record, key):
+        """Store `record` for `item`, under its annex key if it has one, `key` otherwise"""
+        path = op.abspath(item)
+        st = os.stat(item)
+        key = self.keys.pop(path, None) or key
+        self.db.execute("REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+                        (path, key, st.st_size, st.st_mtime_ns, json.dumps(record)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def read_fields(path):
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def read_series(item, index=None):
+    """Bytes of the DICOM file `item`, or of the first file of tarball `item`"""
+    if item.endswith('.dcm'):
+        with open(item, 'rb') as f:
+            return f.read()
+    return read_first_member(item, index)
+
+
+def read_header(item, index=None, profile=None, data=None):
+    """Header record of the series in `item`, a .dcm file or a tarball
+
+    `data` is the content read_series returned for `item` if it was read
+    already.
+    """
+    if profile is None:
+        profile = Profile("read_header")
+    if data is not None:
+        item_to_read = io.BytesIO(data)
+    elif item.endswith('.dcm'):
+        item_to_read = item  # read by pydicom, which stops before the pixels
+    else: # we assume it is a tarball and will read the first from it
+        with profile.timer("read"):
+            data = read_first_member(item, index)
+        profile.count("bytes", len(data))
+        item_to_read = io.BytesIO(data)
+
+    import pydicom  # only imported when a series has to be read
+    with profile.timer("parse"):
+        return header_record(pydicom.dcmread(item_to_read, stop_before_pixels=True))
+
+
+def _read_size(read):
+    return len(read[0])
+
+
+def series_records(source, parameters, index=None, store=None, profile=None, read_ahead=0,
+                   read_ahead_bytes=64 << 20, reader=None):
+    """Yield a record (dict) of the DICOM attributes `parameters` of every series in `source`
+
+    Records have the Date, sid and ses of the series and every attribute,
+    None for the ones a series does not have. `source` can be any iterable
+    of paths and is consumed as the records are. Each series is read once.
+    With a HeaderStore `store` the series already in it are not read at
+    all. A Profile `profile` gets the time spent in every stage. With
+    `read_ahead` threads the series are read (up to `read_ahead_bytes` at
+    once) while the ones before them get parsed, see extractlib.prefetch.
+    `reader` returns the content of a series, read_series by default.
+    """
+    if profile is None:
+        profile = Profile("series_records")
+    if isinstance(parameters, str):
+        parameters = [parameters]
+    progress = Progress(len(source) if hasattr(source, "__len__") else None, unit="series")
+
+    def lookups():
+        # the header cache is only used from this thread
+        for item in source:
+            with profile.timer("cache"):
+                record = store.get(item) if store is not None else None
+            yield item, record
+
+    if reader is None:
+        reader = partial(read_series, index=index)
+
+    def read_uncached(looked_up):
+        # runs on the read-ahead threads, so is the digest the header store needs
+        item, record = looked_up
+        if record is not None:
+            return None
+        data = reader(item)
+        return data, header_key(data) if store is not None else None
+
+    series = prefetch(lookups(), read_uncached, read_ahead, read_ahead_bytes, size=_read_size, profile=profile)
+
+    for (item, record), read in series:  # os.listdir(os.fsencode("derivatives")):          # for each
+        with profile.timer("paths"):
+            info = re.search('.*?ses-(?P<date>[0-9]+).*', item).groupdict()
+            ses = re.search('.*?ses-(?P<ses>[\w]+)_.*', item).groupdict()       # getting session id
+            sid = re.search('.*?sid(?P<sid>[0-9]+)_.*', item).groupdict()      # getting subject id
+
+            # merging dicts for easy access
+            info.update(ses)
+            info.update(sid)
+
+        if read is not None:
+            profile.count("bytes", len(read[0]))
+        if record is None and store is not None:
+            with profile.timer("cache"):
+                record = store.find(item, read[1])
+        if record is None:
+            record = read_header(item, index, profile, read[0])
+            if store is not None:
+                with profile.timer("cache"):
+                    store.put(item, record, read[1])
+        else:
+            profile.count("cached")
+        values = {"Date": info["date"], "sid": "sub-sid" + info["sid"], "ses": info["ses"]}
+        values.update((parameter, record.get(parameter)) for parameter in parameters)
+
+        yield values
+        profile.count("files")
+        progress.update()
+
+    progress.close()
+    with profile.timer("cache"):
+        if index is not None:
+            index.save()
+        if store is not None:
+            store.commit()
+
+
+def extract_parameter(source, parameters, output_csv, index=None, store=None, fmt=None, profile=None,
+                      read_ahead=0, read_ahead_bytes=64 << 20, reader=None):
+    """Write DICOM attributes `parameters` of every series in `source`
+
+    All attributes become columns of the row of a series, see series_records
+    for the parameters. The header store is closed at the end.
+    """
+    if profile is None:
+        profile = Profile("extract_parameter")
+    if isinstance(parameters, str):
+        parameters = [parameters]
+
+    # the destination file is rewritten, with the header row for a CSV
+    write_records(series_records(source, parameters, index, store, profile, read_ahead, read_ahead_bytes, reader),
+                  output_csv, ["Date", "sid", "ses"] + parameters, append=False, fmt=fmt, profile=profile)
+    if store is not None:
+        with profile.timer("cache"):
+            store.close()
 
 
 def main(args=None):
     parser = get_opt_parser()
 
     (options, source) = parser.parse_args(args)
+    source = input_paths(source, options.null)
+
+    parameters = [parameter.strip()
+                  for types in options.type or []
+                  for parameter in types.split(',') if parameter.strip()]
+    if options.fields:
+        parameters += read_fields(options.fields)
 
-    if options.type == None:
+    if not parameters:
         print("Specify what type of DICOM metadata you want!");
     else:
-        extract_parameter(source, options.type, options.output_csv)
+        index = MemberIndex(options.index) if options.index else None
+        store = HeaderStore(options.header_cache) if options.header_cache else None
+        profile = Profile(op.basename(__file__))
+        extract_parameter(source, parameters, options.output_csv, index, store, options.format, profile,
+                          **read_ahead_options(options))
+        if options.profile:
+            profile.save(options.profile)
 
 if __name__ == '__main__':
     main()
@@ -15,6 +15,11 @@ import sys
 from optparse import OptionParser, Option
 from glob import glob
 
+from extractlib import (Manifest, MissingField, Profile, Spec, add_extraction_options, json_decoder, open_output,
+                        option_paths, produce_rows, read_ahead_options)
+import specs
+from bidsindex import entities
+
 # FILE PATHS TO BE ESTABLISHED
 bids_subject = 'qa'
 bids_ds_path = op.join('data', 'QA')
@@ -22,6 +27,7 @@ bids_ds_path = op.join('data', 'QA')
 mriqc_path = op.join(bids_ds_path, 'derivatives', 'mriqc', 'derivatives')
 ses_path = op.join(bids_ds_path, 'sub-qa', 'ses-*')
 
+# default labels, all of which have to be present for a session to be written
 fields = ["Background", "Left-Accumbens-area", "Left-Amygdala", "Left-Caudate", "Left-Hippocampus", "Left-Pallidum",
         "Left-Putamen", "Left-Thalamus-Proper", "Right-Accumbens-area", "Right-Amygdala", "Right-Caudate", "Right-Hippocampus", "Right-Pallidum",
         "Right-Putamen", "Right-Thalamus-Proper", "csf", "gray", "white"]
@@ -29,72 +35,140 @@ fields = ["Background", "Left-Accumbens-area", "Left-Amygdala", "Left-Caudate",
 
 def get_opt_parser():
     # use module docstring for help output
-    p = OptionParser()
+    p = OptionParser(usage="%prog [options] [FILE|-]...")
 
     p.add_options([
         Option("-o", "--output",
                dest="output_csv",
                #required=True,
-               help="Where do you want the extraction to be written to"),
+               help="Where do you want the extraction to be written to. "
+                    "Every statistic goes into its own file with -STAT appended to the name"),
 
-    ])
+        Option("-s", "--stats",
+               dest="stats", default="count,volume",
+               help="Comma separated names of the per-label statistics, in the order they "
+                    "are stored in the JSON files [default: %default]"),
 
-    return p
+        Option("-l", "--labels",
+               dest="labels", default=None,
+               help="Comma separated labels, or a file with one label per line, to extract. "
+                    "'all' takes every label found in the files (missing ones are left empty). "
+                    "By default the subcortical, csf, gray and white labels are extracted"),
 
+    ])
+    add_extraction_options(p)
 
-def segstats_producer(source, output_csv):
-    
-    # opening destination CSV file
-    destination = open(output_csv, "a")
+    return p
 
-    # fires up the CSV writer module
-    product = csv.writer(destination)
-    
-    # WRITES THE HEADER ROW for the CSV
-    product.writerow(["Date", "sid", "ses", "Background", "Left-Accumbens-area", "Left-Amygdala", "Left-Caudate", "Left-Hippocampus", "Left-Pallidum",
-        "Left-Putamen", "Left-Thalamus-Proper", "Right-Accumbens-area", "Right-Amygdala", "Right-Caudate", "Right-Hippocampus", "Right-Pallidum",
-        "Right-Putamen", "Right-Thalamus-Proper", "csf", "gray", "white"])
-
-    for item in source:  # os.listdir(os.fsencode("derivatives")):          # for each
-        print(item)
-        info = re.search('.*?ses-(?P<date>[0-9]+).*', item).groupdict()     # getting date
-        ses = re.search('.*?ses-(?P<ses>[\w]+)_.*', item).groupdict() # getting session id
-        sid = re.search('.*?sub-sid(?P<sid>[0-9]+).*', item).groupdict()    # getting subject id
-        
-        # merging into one dict for easy access
-        info.update(ses)
-        info.update(sid)
-       
-        # FUNC: abbreviations for easier access to certain dicts in the func/.json files
-        func_json = open(os.fsdecode(item), "r").read()  # open sesameeee
-        loaded_func = json.loads(func_json)
-       
-        print(item); # debugging, indicator that a file's been processed
-        
-        if "count" in output_csv:
-            n = 0
-        elif "volume" in output_csv:
-            n = 1
-
-        # if all fields are present
-        present = True
-        for field in fields:
-            if field not in loaded_func:
-                print("Error: field not found")
-                present = False
-
-        if present:
-            product.writerow([info["date"], "sub-sid" + info["sid"], info["ses"], 
-                loaded_func["Background"][n], loaded_func["Left-Accumbens-area"][n], loaded_func["Left-Amygdala"][n], 
-                loaded_func["Left-Caudate"][n], loaded_func["Left-Hippocampus"][n], loaded_func["Left-Pallidum"][n], loaded_func["Left-Putamen"][n],
-                loaded_func["Left-Thalamus-Proper"][n], loaded_func["Right-Accumbens-area"][n], loaded_func["Right-Amygdala"][n], 
-                loaded_func["Right-Caudate"][n], loaded_func["Right-Hippocampus"][n], loaded_func["Right-Pallidum"][n], loaded_func["Right-Putamen"][n], 
-                loaded_func["Right-Thalamus-Proper"][n], loaded_func["csf"][n], loaded_func["gray"][n], loaded_func["white"][n]])
 
+def segstats_row(item, loaded_func):
+    info = entities(item)  # date, session and subject (sub-sidNNNNNN) from the path
+
+    # all statistics of every label, the producer picks what it writes
+    return [info["date"], "sub-" + info["sub"], info["ses"],
+            {label: stats for label, stats in loaded_func.items() if isinstance(stats, list)}]
+
+
+def read_labels(labels):
+    """Labels from a comma separated list or a file with one label per line"""
+    if op.isfile(labels):
+        with open(labels) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [label.strip() for label in labels.split(',') if label.strip()]
+
+
+def segstats_records(source, stats=("count", "volume"), labels=fields, jobs=1, manifest=None, json_backend="auto",
+                     profile=None, read_ahead=0, read_ahead_bytes=64 << 20):
+    """Yield the statistics of the segmentation labels of every JSON in `source`
+
+    Every file gives a dict with a record per statistic, e.g.
+    {"count": {"Date": ..., "sid": ..., "ses": ..., "csf": ...}, "volume": {...}}.
+    Files missing one of `labels` are skipped. With `labels` None the records
+    have the labels found in each file. `source` can be any iterable of paths
+    and is consumed as the records are; see segstats_producer for the other
+    parameters.
+    """
+    if profile is None:
+        profile = Profile("segstats_records")
+
+    if manifest is not None:
+        manifest = Manifest(manifest, "process_segstats %s" % (
+            "all" if labels is None else Spec(specs.segstats_fields(labels, 0)).digest()))
+
+    # Specs of the statistics by label set, files usually all have the same labels
+    stat_specs = {}
+    if labels is not None:
+        stat_specs[None] = [Spec(specs.segstats_fields(labels, n)) for n in range(len(stats))]
+
+    # only the requested labels are kept from the JSONs, so rows (and the manifest) do not hold the others
+    rows = produce_rows(segstats_row, source, jobs, manifest, json_decoder(json_backend, labels), profile=profile,
+                        read_ahead=read_ahead, read_ahead_bytes=read_ahead_bytes)
+    for row in rows:
+        if row is None:
+            continue
+        if labels is None:
+            key = tuple(row[3])
+            if key not in stat_specs:
+                stat_specs[key] = [Spec(specs.segstats_fields(key, n, False)) for n in range(len(stats))]
         else:
-                print("One of the fields is not present.")
-
-    destination.close()
+            key = None
+        try:
+            values = [spec(row[3]) for spec in stat_specs[key]]
+        except MissingField as exc:
+            print("Label %s is not present." % exc)
+            profile.skip("Label %s is not present." % exc)
+            continue
+        yield {stat: dict(zip(["Date", "sid", "ses"] + spec.names, row[:3] + stat_values))
+               for stat, spec, stat_values in zip(stats, stat_specs[key], values)}
+
+
+def segstats_producer(source, output_csv, stats=("count", "volume"), labels=fields, jobs=1, manifest=None,
+                      fmt=None, json_backend="auto", profile=None, read_ahead=0, read_ahead_bytes=64 << 20):
+    """Write every statistic of the segmentation labels in one pass over `source`
+
+    Parameters
+    ----------
+    output_csv: name of the output, "-STAT" is inserted before its extension
+      for each of the `stats`
+    stats: names of the statistics, in the order they are listed per label
+    labels: labels to extract, all of which must be present in a file for its
+      row to be written. None takes all labels found across the files instead,
+      leaving cells of the labels a file does not have empty
+    profile: optional Profile recording the stages of the extraction
+    read_ahead, read_ahead_bytes: threads reading files ahead of the parsing
+      and how much they can read ahead, see produce_rows
+    """
+    if profile is None:
+        profile = Profile("segstats_producer")
+
+    records = segstats_records(source, stats, labels, jobs, manifest, json_backend, profile,
+                               read_ahead, read_ahead_bytes)
+    if labels is None:
+        # the header has to list every label, so records are collected first
+        records = list(records)
+        labels = []
+        seen = {"Date", "sid", "ses"}
+        for record in records:
+            for label in record[stats[0]]:
+                if label not in seen:
+                    seen.add(label)
+                    labels.append(label)
+    header = ["Date", "sid", "ses"] + list(labels)
+
+    base, ext = op.splitext(output_csv)
+    outputs = [
+        # opening destination files, a CSV gets the header row if it is a new one.
+        # With a manifest all rows are produced again, so the files are rewritten
+        open_output(base + "-" + stat + ext, header, append=manifest is None, fmt=fmt, profile=profile)
+        for stat in stats
+    ]
+
+    for record in records:
+        for destination, stat in zip(outputs, stats):
+            destination.writerow([record[stat].get(column) for column in header])
+
+    for destination in outputs:
+        destination.close()
 
 
 def main(args=None):
@@ -102,10 +176,23 @@ def main(args=None):
 
     (options, source) = parser.parse_args(args)
 
-    ses_csv = options.output_csv[:-4] + "-count" + options.output_csv[-4:]
-    sid_csv = options.output_csv[:-4] + "-volume" + options.output_csv[-4:]
-    segstats_producer(source, ses_csv)
-    segstats_producer(source, sid_csv)
+    profile = Profile(op.basename(__file__))
+
+    source = option_paths(options, source, profile)
+
+    if options.labels is None:
+        labels = fields
+    elif options.labels == "all":
+        labels = None
+    else:
+        labels = read_labels(options.labels)
+
+    segstats_producer(source, options.output_csv, options.stats.split(','), labels,
+                      options.jobs, options.manifest, options.format, options.json_backend, profile,
+                      **read_ahead_options(options))
+
+    if options.profile:
+        profile.save(options.profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+# Declarative specifications of the columns extracted from mriqc JSONs
+#
+# Every field names its column, the path of keys (and list indices) to its value,
+# optionally a fallback path where pre-2018 sessions keep it, a type to convert it to
+# and a default. Fields without a default are required: files missing them are skipped.
+# To extract another IQM, add a field here (or pass a JSON list of fields with --spec).
+
+
+def mriqc_fields(iqm):
+    """Fields of an mriqc JSON along with its image quality metric `iqm`"""
+    return (
+        [
+            {"name": iqm, "path": [iqm], "fallback": ["bids_meta", iqm], "type": "float"},
+            {"name": "SAR", "path": ["SAR"], "fallback": ["bids_meta", "SAR"], "type": "float"},
+            {"name": "AcquisitionTime", "path": ["AcquisitionTime"], "fallback": ["bids_meta", "AcquisitionTime"],
+             "type": "seconds"},
+            {"name": "TxRefAmp", "path": ["TxRefAmp"], "fallback": ["bids_meta", "TxRefAmp"], "type": "float"},
+            {"name": "SoftwareVersions", "path": ["bids_meta", "SoftwareVersions"], "type": "str"},
+            {"name": "CSV", "path": ["bids_meta", "ConversionSoftwareVersion"], "type": "str"},
+            {"name": "RepetitionTime", "path": ["bids_meta", "RepetitionTime"]},
+        ]
+        + [{"name": "Shim%d" % (i + 1), "path": ["bids_meta", "ShimSetting", i], "type": "int"}
+           for i in range(8)]
+        + [{"name": "IOPD%d" % (i + 1), "path": ["bids_meta", "ImageOrientationPatientDICOM", i], "type": "float"}
+           for i in range(6)]
+    )
+
+
+func_fields = mriqc_fields("tsnr")
+anat_fields = mriqc_fields("snr_total")
+
+
+def segstats_fields(labels, n, required=True):
+    """Fields picking the `n`-th statistic of every segmentation label"""
+    return [dict({"name": label, "path": [label, n]}, **({} if required else {"default": None}))
+            for label in labels]
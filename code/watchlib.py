@@ -0,0 +1,206 @@
+# Watching a directory tree for files which are added or modified: with inotify (through ctypes,
+# Linux only) when it is available, by comparing the size and mtime of every file otherwise
+
+import os
+import os.path as op
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without its name: wd, mask, cookie, len
+_event = struct.Struct("iIII")
+
+
+def _visible(names):
+    # like bidsindex, files and directories starting with a dot are left out
+    return [name for name in names if not name.startswith('.')]
+
+
+class PollingWatcher(object):
+    """Finds files added or modified under `root` by scanning it every `interval` seconds
+
+    Works on any file system, including network ones where inotify does not
+    see changes made by other hosts. Files whose content is not present
+    (e.g. annexed files which were not fetched) are only seen once it is.
+    """
+
+    def __init__(self, root, interval=5.0):
+        self.root = root
+        self.interval = interval
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for directory, dirs, names in os.walk(self.root):
+            dirs[:] = _visible(dirs)
+            for name in _visible(names):
+                path = op.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def changes(self, timeout=None):
+        """Paths of the files added or modified since the last call
+
+        Waits up to `timeout` seconds (forever if None) for some, and
+        returns an empty set if there were none.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic()))
+            time.sleep(wait)
+            files = self._scan()
+            changed = {path for path, stat in files.items() if self.files.get(path) != stat}
+            self.files = files
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Finds files added or modified under `root` with inotify
+
+    Every directory of the tree is watched, and directories created later
+    are watched as they appear. Raises OSError if inotify is not available
+    or there are more directories than fs.inotify.max_user_watches allows.
+    """
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported on %s" % sys.platform)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, "inotify_init1: %s" % os.strerror(code))
+        self.root = root
+        self.watches = {}
+        try:
+            self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, top):
+        # watches `top` and the directories below it, returning the files already in them
+        files = set()
+        for directory, dirs, names in os.walk(top):
+            dirs[:] = _visible(dirs)
+            wd = self._add_watch(self.fd, os.fsencode(directory), self.mask)
+            if wd < 0:
+                code = ctypes.get_errno()
+                if code in (errno.ENOENT, errno.ENOTDIR):  # removed meanwhile
+                    continue
+                raise OSError(code, "inotify_add_watch %s: %s" % (directory, os.strerror(code)))
+            self.watches[wd] = directory
+            files.update(op.join(directory, name) for name in _visible(names))
+        return files
+
+    def _read(self):
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def changes(self, timeout=None):
+        """Paths of the files added or modified since the last call
+
+        Waits up to `timeout` seconds (forever if None) for some, and
+        returns an empty set if there were none. Returns None if the kernel
+        dropped events, so the tree has to be scanned again.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = self._read()
+        changed = set()
+        lost = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _event.unpack_from(data, offset)
+            name = data[offset + _event.size:offset + _event.size + length].rstrip(b"\0")
+            offset += _event.size + length
+            if mask & IN_Q_OVERFLOW:
+                lost = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name or name.startswith(b'.'):
+                continue
+            path = op.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # files may have landed in it before it was watched
+                changed.update(self._watch_tree(path))
+            else:
+                changed.add(path)
+        return None if lost else changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watcher(root, poll=None):
+    """A watcher of `root`: polling every `poll` seconds if given, with inotify otherwise
+
+    Falls back to polling every 5 seconds when inotify cannot be used.
+    """
+    if poll is None:
+        try:
+            return InotifyWatcher(root)
+        except OSError as exc:
+            poll = 5.0
+            print("Cannot watch %s with inotify (%s), polling every %g s instead" % (root, exc, poll),
+                  file=sys.stderr)
+    return PollingWatcher(root, poll)
+
+
+def settled_changes(watcher, settle=2.0, timeout=None):
+    """Changes reported by `watcher` once there were none for `settle` seconds
+
+    Files are usually written in several steps, so this waits for writing
+    to be over before they get read. Waits up to `timeout` seconds (forever
+    if None) for a first change. Returns None if events were lost.
+    """
+    changed = watcher.changes(timeout)
+    if not changed:
+        return changed
+    while True:
+        more = watcher.changes(settle)
+        if more is None:
+            changed = None
+        elif not more:
+            return changed
+        elif changed is not None:
+            changed |= more
@@ -1,21 +1,57 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
-import statsmodels.api as sm
 import datetime as dt
+import multiprocessing
+import os
+import re
+import sys
+import time
 
-from statsmodels.stats.multitest import fdrcorrection
-from pylab import savefig
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import islice
+
+# the column types of extractions are defined along with the extraction scripts, in code/extractlib.py
+_code_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code')
+if _code_path not in sys.path:
+    sys.path.append(_code_path)
+from extractlib import column_types, typed_frame
+
+# matplotlib, seaborn, scipy and statsmodels take seconds to import, so they are imported by the functions
+# which need them: batch jobs which only fit models (or only orthogonalize) never load the plotting stack
 
 
 # FUNCTIONS YOU CAN USE:
+#     read_extraction(filepath) loads the output of one of the code/process_*.py scripts (CSV, Parquet or Feather)
+#
+#     load_extraction(rows, header) turns extraction output (rows, records, a DataFrame or a file) into a
+#       DataFrame with typed columns, ready for regress
+#       load_extraction(qa_metric_records(paths)) builds it straight from the record generators of code/process_*.py
+#
+#     join_qa(sessions, qa) attaches to every human session the QA metrics of the closest QA session
+#
 #     analyses(filepath) spits out a nifty heatmap to let you check correlation between variables
+#       analyses(filepath, chunksize=100000) does the same reading the file in chunks, for tables too large for memory
 #
 #     regress(option, df) churns out a saucy graph of the linear regression for the variables you provided, where
 #       option is 'snr_total' or 'tsnr', whichever you want to make the dependent variable of your model
 #       df is the pandas DataFrame containing your data. To modify which variables you want in your model, you'll
 #             have to directly modify the regress function
+#       regress(option, df, plot=False, fast=True) skips statsmodels and all printing and returns a compact RegressFit
+#
+#     plot_targets(targets, df, directory) saves the graph of regress for every target, rendered in parallel
+#
+#     drift_report(qa_df) refits the QA drift model of regress and summarizes it, with the residual of the latest
+#       session (what process_QA_metrics.py --watch --refit writes after every update)
+#
+#     fit_targets(targets, df) fits the model of regress to many targets (e.g. all segstats regions) at once and
+#       returns params, standard errors, p-values, F-tests and R2 of all of them as arrays
+#
+#     sweep_significance(targets, variables, df) tests every variable for every target on all cores and returns
+#       a tidy table with one FDR correction per variable
+#
+#     resample_significance(option, df) computes permutation or block bootstrap p-values of the variables and
+#       F-tests of the model of regress, for series too autocorrelated to trust the parametric ones
 
 
 
@@ -26,6 +62,12 @@ from pylab import savefig
 
 
 
+def fdrcorrection(pvals, alpha=0.05):
+    # statsmodels.stats.multitest.fdrcorrection, imported on first use
+    from statsmodels.stats.multitest import fdrcorrection
+    return fdrcorrection(pvals, alpha)
+
+
 def filter(option, df):
     is_p2 = df['Filetype'] == "task-rest_acq-p2_bold.json"
     is_x = df['Filetype'] == "task-rest_acq-p2Xs4X35mm_bold.json"
@@ -36,21 +78,210 @@ def filter(option, df):
         return df[is_p2]
 
 
-def analyses(filepath):
-    files = pd.read_csv(filepath)
+def read_extraction(filepath, columns=None):
+    """
+    loads an extraction produced by one of the code/process_*.py scripts
+
+    Parameters
+    ----------
+       filepath: path to a .csv, .parquet or .feather extraction
+       columns : optional list of the columns to load
+
+    Parquet and Feather extractions are stored with their column types (dates, categories,
+    float32 Shim/IOPD), so they are loaded without any parsing; CSVs are converted to the same
+    types (see typed_extraction).
+    """
+    if filepath.endswith('.parquet'):
+        return typed_extraction(pd.read_parquet(filepath, columns=columns))
+    if filepath.endswith('.feather'):
+        return typed_extraction(pd.read_feather(filepath, columns=columns))
+
+    # labels are read as written, e.g. zero-padded sids
+    labels = {column: str for column, type_ in column_types.items() if type_ == 'category'}
+    return typed_extraction(pd.read_csv(filepath, usecols=columns, dtype=labels, float_precision='round_trip'))
+
+
+def typed_extraction(df):
+    """
+    converts the columns of an extraction DataFrame to the types used for the analyses, in place
+
+    These are the types Parquet and Feather extractions are written with (extractlib.column_types), so an
+    extraction loads the same whatever its format: Date becomes datetime64, AcquisitionTime seconds since
+    midnight, label columns categoricals, Shim and IOPD float32, and the remaining ones numbers where possible.
+    """
+    return typed_frame(df)
+
+
+def load_extraction(source, header=None, chunksize=50000):
+    """
+    builds an analysis-ready DataFrame straight from extraction output, without a CSV round-trip
+
+    Parameters
+    ----------
+       source   : a path to an extraction file, a DataFrame, or an iterable of rows (lists, with their
+                  column names in `header`) or of records (dicts), e.g. one of the *_records generators of
+                  code/process_*.py
+       header   : column names of the rows in `source`
+       chunksize: number of rows turned into columns at once, so only that many rows are held as Python
+                  objects while `source` is consumed
+
+    Returns the DataFrame with the column types of typed_extraction.
+    """
+    if isinstance(source, str):
+        return read_extraction(source)
+    if isinstance(source, pd.DataFrame):
+        df = source.copy()
+    else:
+        rows = (row for row in source if row is not None)
+        frames = []
+        while True:
+            chunk = list(islice(rows, chunksize))
+            if not chunk:
+                break
+            frames.append(pd.DataFrame(chunk, columns=header))
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else (
+            frames[0] if frames else pd.DataFrame(columns=header))
+    return typed_extraction(df)
+
+
+def join_qa(sessions, qa, columns=None, direction='nearest', tolerance='7D', suffixes=('_real', '_qa'),
+            lag_column='qa_lag'):
+    """
+    attaches to every session the QA (phantom) session closest in time
+
+    Parameters
+    ----------
+       sessions  : DataFrame of (human) sessions with a Date column
+       qa        : DataFrame of a QA extraction with a Date column and one row per QA session, e.g. filter('x', qa)
+       columns   : columns of qa to carry over (default: all of them)
+       direction : 'nearest' QA session, or the last one on or before the session date ('backward')
+       tolerance : maximal time between a session and its QA session (e.g. '7D'), None for no limit; sessions
+                   without a QA session that close get NaN
+       suffixes  : suffixes of columns present in both sessions and qa, e.g. snr_total becomes snr_total_qa
+       lag_column: name of the column with the number of days from the QA session to the session
+
+    All sessions are matched in one pass of pd.merge_asof over the QA sessions sorted by date. Sessions keep
+    their order and index.
+    """
+    if columns is None:
+        columns = [c for c in qa.columns if c != 'Date']
+    right = typed_extraction(qa[['Date'] + list(columns)].copy())
+    right['_qa_date'] = right['Date']
+    right = right.sort_values('Date', kind='mergesort')
+
+    left = sessions.copy()
+    if not pd.api.types.is_datetime64_any_dtype(left['Date']):
+        left['Date'] = pd.to_datetime(left['Date'].astype(str), format="%Y%m%d")
+    left['_position'] = np.arange(len(left))
+    index = left.index
+    left = left.sort_values('Date', kind='mergesort')
+
+    if tolerance is not None:
+        tolerance = pd.Timedelta(tolerance)
+    joined = pd.merge_asof(left, right, on='Date', direction=direction, tolerance=tolerance, suffixes=suffixes)
+    joined = joined.sort_values('_position')
+    joined.index = index
+    if lag_column:
+        joined[lag_column] = (joined['Date'] - joined['_qa_date']).dt.days
+    return joined.drop(['_position', '_qa_date'], axis=1)
+
+
+def date_ordinals(dates):
+    """
+    proleptic Gregorian ordinals (as of date.toordinal()) of a Series of dates, vectorized
+    """
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates.astype(str), format="%Y%m%d")
+    # 719163 is the ordinal of 1970-01-01, the datetime64 epoch
+    return dates.values.astype('datetime64[D]').astype(np.int64) + 719163
+
+
+def read_chunks(filepath, chunksize):
+    """
+    iterates over an extraction (.csv, .parquet or .feather) in DataFrames of at most `chunksize` rows
+
+    CSV and Parquet files are streamed, Feather files are read at once and then split.
+    """
+    if filepath.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif filepath.endswith('.feather'):
+        frame = pd.read_feather(filepath)
+        for start in range(0, len(frame), chunksize):
+            yield frame.iloc[start:start + chunksize]
+    else:
+        for chunk in pd.read_csv(filepath, chunksize=chunksize):
+            yield chunk
+
+
+class PairwiseCorrelation(object):
+    """
+    correlation matrix of the numeric columns of a table, accumulated from chunks of its rows
+
+    As DataFrame.corr(), every pair of columns is correlated over the rows where both are present.
+    Only sums of products are kept, so memory does not depend on the number of rows. Values are taken
+    relative to the means of the first chunk to keep the sums numerically stable.
+    """
+
+    def __init__(self):
+        self.columns = None
+
+    def update(self, chunk):
+        if self.columns is None:
+            self.columns = list(chunk.select_dtypes(include='number').columns)
+            self.shift = chunk[self.columns].mean().fillna(0).to_numpy()
+            p = len(self.columns)
+            self.n, self.sx, self.sxx, self.sxy = (np.zeros((p, p)) for _ in range(4))
+        values = chunk[self.columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float) - self.shift
+        present = np.isfinite(values).astype(float)
+        values = np.where(present > 0, values, 0)
+        # [i, j] entries sum over the rows where both column i and column j are present
+        self.n += np.dot(present.T, present)
+        self.sx += np.dot(values.T, present)
+        self.sxx += np.dot((values ** 2).T, present)
+        self.sxy += np.dot(values.T, values)
+
+    def corr(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.sxy - self.sx * self.sx.T / self.n
+            var = self.sxx - self.sx ** 2 / self.n
+            corr = cov / np.sqrt(var * var.T)
+        corr[self.n < 2] = np.nan
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.columns, columns=self.columns)
+
+
+def analyses(filepath, chunksize=None):
+    """
+    checks that all rows of an extraction share the same conversion software (8th column) and saves a
+    heatmap of the correlations between its numeric columns to heatmap.svg
+
+    With `chunksize`, the extraction is read and processed `chunksize` rows at a time, so tables too large
+    to be loaded at once can be checked.
+    """
+    if chunksize is None:
+        chunks = [pd.read_csv(filepath) if filepath.endswith('.csv') else read_extraction(filepath)]
+    else:
+        chunks = read_chunks(filepath, chunksize)
     
     # FIRST CHECK: CONVERSION SOFTWARE VERSIONS
-    check = files.iloc[0, 7]
+    check = None
     valid = True
+    correlation = PairwiseCorrelation()
     
-    for i in files.index:
-        if check != files.iloc[i, 7]:
-            valid = False
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        if check is None:
+            check = chunk.iloc[0, 7]
+        valid = valid and not (chunk.iloc[:, 7] != check).any()
+        correlation.update(chunk)
             
     print("All Conversion Softwares are the same: " + str(valid))
     
     # SECOND CHECK: HEATMAP
-    figure = sns.heatmap(files.corr(), cmap=sns.diverging_palette(h_neg=240, h_pos=10, n=9, sep=1, center="dark"), center=0)
+    import seaborn as sns
+    figure = sns.heatmap(correlation.corr(), cmap=sns.diverging_palette(h_neg=240, h_pos=10, n=9, sep=1, center="dark"), center=0)
     figure
     
     save = figure.get_figure()    
@@ -61,11 +292,18 @@ def analyses(filepath):
 def add_seasonal_simple(df, col='Date', start='2017-01-01'):
     # Add a very simplistic seasonal regressors as cos and sin since some date in a year
     time_delta = df[col] - np.datetime64(start)
-    time_delta_rad = time_delta.apply(lambda d: d.days) * 2 * np.pi / 365.25
+    time_delta_rad = time_delta.dt.days * 2 * np.pi / 365.25
     df['Seasonal (sin)'] = np.sin(time_delta_rad)
     df['Seasonal (cos)'] = np.cos(time_delta_rad)
 
 
+# variables marked significant when the F-test of their prefix is
+f_test_variables = {
+    'Shim': ['Shim%d' % (i+1) for i in range(8)],
+    'IOPD': ['IOPD%d' % (i+1) for i in range(6)],
+}
+
+
 def Ftest(model, var_prefix, queue, prints=False):
     var_columns = [c for c in model.params.index if c.startswith(var_prefix)]
     
@@ -73,12 +311,7 @@ def Ftest(model, var_prefix, queue, prints=False):
         f_test = model.f_test(' = '.join(var_columns) + " = 0")
         
         if f_test.pvalue < 0.05:
-            if var_prefix == "Shim":
-                for i in range(8):
-                    queue.append("Shim" + str(i+1))
-            elif var_prefix == "IOPD":
-                for i in range(6):
-                    queue.append("IOPD" + str(i+1))
+            queue.extend(f_test_variables.get(var_prefix, []))
                     
         if prints:
             print("%s F-test: %s" % (var_prefix, f_test))
@@ -90,45 +323,89 @@ def Ftest(model, var_prefix, queue, prints=False):
         return None
 
 
-# copy pasted from nipy function, renamed from _orthogonalize
-def orthogonalize(X):
+# same semantics as nipy's _orthogonalize, computed from a single QR factorization
+def orthogonalize(X, return_factorization=False):
     """ Orthogonalize every column of design `X` w.r.t preceding columns
     Parameters
     ----------
     X: array of shape(n, p), the data to be orthogonalized
+    return_factorization: boolean to also return the QR factorization of `X`
     Returns
     -------
     X: after orthogonalization
+    (Q, R, independent): if return_factorization, Q of shape (n, k) with orthonormal columns spanning the k
+            independent columns of `X`, whose indices are `independent`, and R of shape (k, p) such that the
+            original `X` is np.dot(Q, R). Column independent[j] of the result is Q[:, j] * R[j, independent[j]]
     Notes
     -----
-    X is changed in place. the columns are not normalized
+    X is changed in place if it is a float array, otherwise a float copy is returned. the columns are
+    not normalized. Column i of the result is the residual of X[:, i] on X[:, :i], i.e. Q[:, i] * R[i, i],
+    so the whole design is handled by one Householder factorization rather than a pseudo-inverse per
+    column. Columns which are (numerically) spanned by the preceding ones come out as zeros, as with
+    the pseudo-inverse, and are left out of Q.
     """
-    if X.size == X.shape[0]:
+    if X.dtype.kind != 'f':
+        X = X.astype(float)
+    if X.size == X.shape[0] and not return_factorization:
         return X
-    for i in range(1, X.shape[1]):
-        X[:, i] -= np.dot(X[:, i], np.dot(X[:, :i], np.linalg.pinv(X[:, :i])))
+
+    independent = np.arange(X.shape[1])
+    while True:
+        Q, R = np.linalg.qr(X[:, independent])
+        diag = np.abs(np.diag(R))
+        # same cutoff as the rcond of np.linalg.pinv, relative to the largest column norm
+        dependent = np.flatnonzero(diag <= 1e-15 * np.abs(R).max())
+        if not len(dependent):
+            break
+        # columns after a dependent one are factored against a spurious direction, so drop
+        # dependent columns one at a time and factor again
+        independent = np.delete(independent, dependent[0])
+
+    if return_factorization:
+        factorization = (Q, np.dot(Q.T, X), independent)
+    X[:, :] = 0
+    X[:, independent] = Q * np.diag(R)
+    if return_factorization:
+        return X, factorization
     return X
 
 
-def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=True, add_seasonal=True, real_data=False):
+@contextmanager
+def timer(timings, stage):
+    # adds the time spent in the block to timings[stage], unless timings is None
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def build_design(targets, model_df, add_qa=True, add_seasonal=True, real_data=False, timings=None):
     """
-    creates a regression graph plotted against actual data from certain QA metrics
+    builds the nuisance design shared by regress and fit_targets
 
     Parameters
     ----------
-       target_variable: takes str value of either snr_total or tsnr to model against
-       model_df       : takes pandas DataFrame with data to be used for predictive modeling
-       plot           : boolean to turn the plotted graph on/off
-       print_summary  : boolean to turn the printed summary of OLS regression on/off
-       add_qa         : boolean to add/not add snr_total_qa into list of variables to be modeled
-       add_seasonal   : boolean to add/not add seasonal variables into list of variables to be modeled
-       real_data      : boolean to indicate whether or not the pandas DataFrame being fed in is from real data or not
+       targets     : str or list of str, the column(s) to be modeled
+       model_df    : pandas DataFrame with data to be used for predictive modeling
+       add_qa      : boolean to add/not add snr_total_qa into list of variables to be modeled
+       add_seasonal: boolean to add/not add seasonal variables into list of variables to be modeled
+       real_data   : boolean to indicate whether or not model_df is from real data or not
+       timings     : optional dict getting the time spent orthogonalizing ('orthogonalize') and in the rest of
+                     the design construction ('design')
+
+    Returns (X, Y, dates, f_tests_todo, factorization): the orthogonalized, centered design with a leading
+    'const' column, the DataFrame of targets, the dates of the samples, the prefixes of the variables to be
+    F-tested and the QR factorization of X (see design_factorization). All of them keep the index of
+    model_df. Date is only used to orthogonalize the other variables (i.e. to detrend them) and is not part
+    of X itself.
     """
-    
-    if type(model_df) is not pd.core.frame.DataFrame:
-        return "DataFrame must be of type pandas.core.frame.DataFrame"
-    
-    
+    if isinstance(targets, str):
+        targets = [targets]
+
     ########## adding seasonal curves to the model
     add_seasonal_simple(model_df)
     
@@ -136,11 +413,9 @@ def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=Tru
     ########## Converting date to a format that can be parsed by statsmodels API
     model_df = model_df.copy()
     date_df = model_df['Date']
-    model_df['Date'] = pd.to_datetime(model_df['Date'], format="%Y%m%d")
-    model_df['Date'] = model_df['Date'].map(lambda x: x.toordinal())
+    model_df['Date'] = date_ordinals(model_df['Date'])
     
     f_tests_todo = ['IOPD']
-    excluded_cols = ['Date', 'IOPD1', 'IOPD2', 'IOPD3', 'IOPD4', 'IOPD5', 'IOPD6', 'Seasonal (sin)', 'Seasonal (cos)']
     seasonal_cols = ['Seasonal (sin)', 'Seasonal (cos)',]
 
     cols = ['Date']
@@ -160,83 +435,150 @@ def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=Tru
 
     if add_seasonal:
         f_tests_todo += ['Seasonal']
-               
-    cols.append(target_variable)
-    
-    model_df = model_df[cols]
    
     # There is apparently a sample date (20170626) with SAR being unknown None/NaN
     # For now we will just filter out those samples
-    if 'SAR' in model_df.columns:
+    if 'SAR' in cols:
         finite_SAR = np.isfinite(model_df['SAR'])
         if not np.all(finite_SAR):
             print("Following dates didn't have SAR, excluding them: %s" % str(model_df['Date'][~finite_SAR]))
             model_df = model_df[finite_SAR]
-    
+            date_df = date_df[finite_SAR]
 
-    orthogonalized_df = model_df.drop(target_variable, axis=1)  # avoid orthogonalizing target variable
-    cols = cols[:-1] # remove target variable from column list
-    
-    # orthogonalize dataframe after its conversion to NumPy array, then convert back and replace in original model_df
-    model_array = orthogonalize(orthogonalized_df.to_numpy())
-    orthogonalized_df = pd.DataFrame(model_array)
-    orthogonalized_df.columns = [cols]
-    orthogonalized_df[target_variable] = pd.Series(model_df[target_variable])
-    model_df = orthogonalized_df
-    
-    # add datetime64[ns] formatted date time
-    model_df.columns=[x[0] for x in model_df.columns]
-    model_df['Date'] = pd.to_datetime(model_df['Date'])
-    model_df = model_df.drop('Date', axis=1) 
-    model_df['Date'] = date_df
-    
-    
-    ########## Assigning independent and dependent variables
-    model_vars = []
+    # orthogonalize the design (without the targets) after its conversion to NumPy array, dropping Date
+    # once every other variable is orthogonalized w.r.t. it
+    with timer(timings, 'orthogonalize'):
+        orthogonal, (Q, R, independent) = orthogonalize(model_df[cols].to_numpy(), return_factorization=True)
+    X = pd.DataFrame(orthogonal, index=model_df.index, columns=cols)
+    X = X.drop('Date', axis=1)
+    X = X.sub(X.mean())
+    X.insert(0, 'const', 1.0)
     
-    for item in model_df.std().iteritems():
-        if item[0] != 'Date' and item[0] != target_variable:
-            model_vars.append(item[0])
+    return X, model_df[targets], date_df, f_tests_todo, design_factorization(Q, R, independent)
 
-    X = model_df[model_vars]
-    y = model_df[target_variable]
-    X = X.sub(X.mean())
-    X = sm.add_constant(X)
+
+def design_factorization(Q, R, independent):
+    """
+    QR factorization of the design of build_design, from the one orthogonalize computed for it
+
+    Parameters
+    ----------
+       Q, R, independent: the factorization returned by orthogonalize for Date followed by the other variables
+
+    The orthogonalized variables are np.dot(Q, T) for a sparse T, and the constant is its projection on Q
+    plus a residual direction u, so the design (constant, then the centered variables without Date) is
+    np.dot([Q, u], M) for a small M: only M, of shape (k + 1, p), is factored again.
+
+    Returns (Q, R, columns) such that the columns `columns` of the design are np.dot(Q, R), with R square
+    and upper triangular, or None if these columns are not linearly independent. The other columns of the
+    design are zeros: the variables orthogonalize found spanned by the preceding ones.
+    """
+    n, k = Q.shape
+    rows = np.arange(k)
+    T = np.zeros_like(R)
+    T[rows, independent] = R[rows, independent]
+    T = T[:, 1:]
+    ones = Q.sum(axis=0)  # the constant in the basis of Q
+    residual = 1 - np.dot(Q, ones)
+    norm = np.linalg.norm(residual)
+    means = np.dot(ones, T) / n
+    M = np.vstack([np.hstack([ones[:, None], T - np.outer(ones, means)]),
+                   np.hstack([norm, -norm * means])])
+    basis = np.hstack([Q, residual[:, None] / norm]) if norm > 1e-10 * np.sqrt(n) else Q
+    columns = np.flatnonzero(np.any(M != 0, axis=0))
+    Qm, Rm = np.linalg.qr(M[:len(basis.T), columns])
+    diag = np.abs(np.diag(Rm))
+    if len(diag) < len(columns) or diag.min() <= 1e-12 * diag.max():
+        return None
+    return np.dot(basis, Qm), Rm, columns
+
+
+# compact result of regress(fast=True): params and pvalues are Series indexed by variable, f_pvalues a dict of the
+# F-test p values, fdr a DataFrame of the p values entering the FDR correction, partial_fits a DataFrame with the
+# partial fit (X * beta) of every significant variable
+RegressFit = namedtuple('RegressFit', ['params', 'pvalues', 'f_pvalues', 'fdr', 'rsquared',
+                                       'significant_variables', 'partial_fits', 'predictions'])
+
+
+def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=True, add_seasonal=True, real_data=False,
+            fast=False, print_fdr=True, plot_file="test.svg", timings=None):
+    """
+    creates a regression graph plotted against actual data from certain QA metrics
+
+    Parameters
+    ----------
+       target_variable: takes str value of either snr_total or tsnr to model against
+       model_df       : takes pandas DataFrame with data to be used for predictive modeling
+       plot           : boolean to turn the plotted graph on/off
+       print_summary  : boolean to turn the printed summary of OLS regression on/off
+       add_qa         : boolean to add/not add snr_total_qa into list of variables to be modeled
+       add_seasonal   : boolean to add/not add seasonal variables into list of variables to be modeled
+       real_data      : boolean to indicate whether or not the pandas DataFrame being fed in is from real data or not
+       fast           : boolean to fit with fit_design instead of statsmodels and return a RegressFit, without
+                        any printing
+       print_fdr      : boolean to turn the printed table of FDR-corrected p-values on/off
+       plot_file      : file the graph is saved to, its extension giving the format (e.g. .svg or .png). In fast
+                        mode the graph is drawn by render_fit, without confidence intervals
+       timings        : optional dict getting the seconds spent in every stage: 'design', 'orthogonalize' (which
+                        is not included in 'design'), 'fit', 'f_tests' (part of 'fit' in fast mode), 'fdr',
+                        'summary' and 'plot'
+    """
+    
+    if type(model_df) is not pd.core.frame.DataFrame:
+        return "DataFrame must be of type pandas.core.frame.DataFrame"
     
-    model_df = sm.add_constant(model_df)
+    start = time.perf_counter()
+    stages = {}
+    X, y, date_df, f_tests_todo, factorization = build_design(target_variable, model_df, add_qa=add_qa,
+                                                              add_seasonal=add_seasonal, real_data=real_data,
+                                                              timings=stages)
+    if timings is not None:
+        timings['orthogonalize'] = timings.get('orthogonalize', 0.0) + stages['orthogonalize']
+        timings['design'] = timings.get('design', 0.0) + time.perf_counter() - start - stages['orthogonalize']
+    y = y[target_variable]
+    cols = ['Date'] + list(X.columns[1:])
+    excluded_cols = ['Date', 'IOPD1', 'IOPD2', 'IOPD3', 'IOPD4', 'IOPD5', 'IOPD6', 'Seasonal (sin)', 'Seasonal (cos)']
+    model_df = pd.DataFrame({'Date': date_df, target_variable: y})
     
     
     ########## modeling predictions
-    model = sm.OLS(y, X).fit()
-    predictions = model.predict(X)
-    
-    ################ CODE FOR TESTING INDIVIDUAL VARIABLE EFFECTS ####################
     significant_variables = []
-    F_tests_pvals = {
-       v: float(Ftest(model, v, significant_variables).pvalue)
-       for v in f_tests_todo
-    }
+    if fast:
+        print_summary = print_fdr = False
+        with timer(timings, 'fit'):
+            fit = fit_design(X, y.to_frame(), f_tests_todo, factorization)
+        params = pd.Series(fit.params[:, 0], index=fit.variables)
+        pvalues = pd.Series(fit.pvalues[:, 0], index=fit.variables)
+        F_tests_pvals = {v: float(fit.f_pvalues[fit.f_tests.index(v), 0]) for v in fit.f_tests}
+        for v, pvalue in F_tests_pvals.items():
+            if pvalue < 0.05:
+                significant_variables.extend(f_test_variables.get(v, []))
+        predictions = X.dot(params)
+    else:
+        import statsmodels.api as sm
+        with timer(timings, 'fit'):
+            model = sm.OLS(y, X).fit()
+            params, pvalues = model.params, model.pvalues
+            predictions = model.predict(X)
+    
+        ################ CODE FOR TESTING INDIVIDUAL VARIABLE EFFECTS ####################
+        with timer(timings, 'f_tests'):
+            F_tests_pvals = {
+               v: float(Ftest(model, v, significant_variables).pvalue)
+               for v in f_tests_todo
+            }
     
     # get p-values
-    for key, value in dict(model.pvalues).items():
+    for key, value in dict(pvalues).items():
         if key not in significant_variables and value < 0.05 or key.lower() == 'const':
             # identify statistically insignificant variables in df
             significant_variables.append(key)
     
     
-    ######## set statistically insignificant variables to 0, then predict
-        
-    partial_fits = {}  # partial_fits = {}
-
-    for variable in significant_variables:
-
-        X2 = X.copy(True) # prepare for mods
-
-        for col in X2:
-            if col != variable:
-                X2[col] = 0
-        
-        partial_fits[str(variable)] = model.predict(X2)
+    ######## partial fits: predictions with statistically insignificant variables set to 0, i.e. X * beta
+    # column-wise (F-tested variables may be significant without being in the model)
+    fitted_variables = [v for v in significant_variables if v in X.columns]
+    partial_fits = X[fitted_variables] * params[fitted_variables]
      
     if print_summary:
         print("Statistically significant variables: " + str(significant_variables))
@@ -258,26 +600,35 @@ def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=Tru
            continue
         
         if var not in excluded_cols:
-            var_pvalue = getattr(model.pvalues, var)
+            var_pvalue = pvalues[var]
             outvars[var] = var_pvalue
    
     outvars.update(F_tests_pvals) # add previously conducted F test p values to the outvars
 
-    FDR_tuple = fdrcorrection(list(outvars.values())) # actual FDR test conduct
+    with timer(timings, 'fdr'):
+        FDR_tuple = fdrcorrection(list(outvars.values())) # actual FDR test conduct
     t_f = list(FDR_tuple[0]) # split tuple into true/false array
     FDR_pvals = list(FDR_tuple[1]) # split tuple into p value array
     
-    print("FDR-corrected p-values:")
-    for (var, value), fdr_pval, is_sign in zip(outvars.items(), FDR_pvals, t_f):
-        print("%15s | Original  p-value: %8.3g" % (var, value) +
-              " | FDR-corrected p-value: %8.3g%s" % (fdr_pval, '**' if is_sign else ''))
-    print("\n")
+    if print_fdr:
+        print("FDR-corrected p-values:")
+        for (var, value), fdr_pval, is_sign in zip(outvars.items(), FDR_pvals, t_f):
+            print("%15s | Original  p-value: %8.3g" % (var, value) +
+                  " | FDR-corrected p-value: %8.3g%s" % (fdr_pval, '**' if is_sign else ''))
+        print("\n")
 
     # giving additional data
     if print_summary:
-        print(model.summary())
-        print("AIC: " + str(model.aic))
-        print("BIC: " + str(model.bic))
+        with timer(timings, 'summary'):
+            print(model.summary())
+            print("AIC: " + str(model.aic))
+            print("BIC: " + str(model.bic))
+    
+    if fast:
+        fdr = pd.DataFrame({'p value': list(outvars.values()), 'FDR-corrected': FDR_pvals, 'significant': t_f},
+                           index=list(outvars.keys()))
+        model = RegressFit(params, pvalues, F_tests_pvals, fdr, fit.rsquared[0],
+                           significant_variables, partial_fits, predictions)
     
     if not plot:
         return model
@@ -290,20 +641,18 @@ def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=Tru
     plot_df = plot_df.join(model_df['Date'])
     plot_df = plot_df.join(model_df[target_variable])
     
-    summation_df = None
+    if len(partial_fits.columns):
+        plot_df['partial fit'] = partial_fits.sum(axis=1)
     
-    for key, value in partial_fits.items():
-        column = value.to_frame()
-        column.columns = ['partial fit']
-
-        if summation_df is None:
-            summation_df = column          # used to add up the values
-        else:
-            summation_df = summation_df.add(column, axis=1)
-    
-    plot_df = pd.concat([plot_df, summation_df], axis=1)
+    if fast:
+        with timer(timings, 'plot'):
+            render_fit((target_variable, plot_df, plot_file))
+        return model
     
     # plotting the graph
+    start = time.perf_counter()
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     plt.figure(figsize=(15, 6))
 
     ax = sns.lineplot(x="Date", y=target_variable, data=plot_df, color="#000000")
@@ -311,40 +660,469 @@ def regress(target_variable, model_df, plot=True, print_summary=True, add_qa=Tru
     # plotting partial fit
     ax_partial = plt.twinx()
     sns.lineplot(x="Date", y="full fit", data=plot_df, color="r", ax=ax)
-    if partial_fits:
+    if len(partial_fits.columns):
         sns.lineplot(x="Date", y="partial fit", data=plot_df, color="#ffcccc", ax=ax_partial)
         plt.ylim(145, 305)
         ax_partial.legend(['partial fit'])
     
     ax.legend(['actual', 'full fit'], loc='upper left')
-    plt.savefig("test.svg")
+    plt.savefig(plot_file)
+    if timings is not None:
+        timings['plot'] = timings.get('plot', 0.0) + time.perf_counter() - start
     
     return model
 
 
+def render_fit(args):
+    """
+    draws the graph of regress from its plot data and saves it
+
+    Parameters
+    ----------
+       args: tuple of the target variable, the DataFrame with the Date, target, 'full fit' and (optional)
+             'partial fit' columns, and the file to save the graph to (its extension giving the format)
+
+    Samples sharing a date are averaged, with no confidence interval estimation, and the figure is drawn
+    on its own Agg canvas, without going through pyplot, so graphs can be rendered in parallel.
+    """
+    target_variable, plot_df, filename = args
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    means = plot_df.groupby('Date').mean()
+    figure = Figure(figsize=(15, 6))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(111)
+    ax.plot(means.index, means[target_variable], color="#000000")
+    ax.plot(means.index, means['full fit'], color="r")
+    ax.set_xlabel('Date')
+    ax.set_ylabel(target_variable)
+    if 'partial fit' in means.columns:
+        ax_partial = ax.twinx()
+        ax_partial.plot(means.index, means['partial fit'], color="#ffcccc")
+        ax_partial.set_ylim(145, 305)
+        ax_partial.legend(['partial fit'])
+    ax.legend(['actual', 'full fit'], loc='upper left')
+    figure.savefig(filename)
+    return filename
+
+
+def plot_targets(targets, model_df, directory='.', fmt='png', jobs=None, add_qa=True, add_seasonal=True,
+                 real_data=False):
+    """
+    saves the graph of regress for every target, as <directory>/<target>.<fmt>
+
+    Parameters
+    ----------
+       targets  : list of str, the columns of model_df to model
+       model_df : pandas DataFrame with data to be used for predictive modeling
+       directory: directory the graphs are saved to
+       fmt      : format of the graphs, a raster one (png) being much faster to write than svg
+       jobs     : number of processes rendering the graphs (default: all cores)
+       add_qa, add_seasonal, real_data: as for regress
+
+    Targets are fitted in fast mode and the graphs drawn by render_fit on a pool of processes.
+
+    Returns the list of files written.
+    """
+    targets = list(targets)
+    jobs = min(jobs or os.cpu_count() or 1, len(targets)) or 1
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    tasks = []
+    for target in targets:
+        fit = regress(target, model_df.copy(), plot=False, fast=True, add_qa=add_qa,
+                      add_seasonal=add_seasonal, real_data=real_data)
+        plot_df = fit.predictions.to_frame('full fit')
+        plot_df['Date'] = model_df.loc[plot_df.index, 'Date']
+        plot_df[target] = model_df.loc[plot_df.index, target]
+        if len(fit.partial_fits.columns):
+            plot_df['partial fit'] = fit.partial_fits.sum(axis=1)
+        filename = os.path.join(directory, "%s.%s" % (re.sub(r'[^\w.-]+', '_', target), fmt))
+        tasks.append((target, plot_df, filename))
+
+    return pool_map(render_fit, tasks, jobs)
+
+
+def drift_report(qa, target='tsnr', option='x', plot_file=None):
+    """
+    refits the QA drift model of regress (in fast mode) and summarizes it, e.g. for monitoring the scanner
+
+    Parameters
+    ----------
+       qa       : pandas DataFrame of a QA extraction, e.g. read_extraction('output.csv')
+       target   : QA metric to model, tsnr or snr_total
+       option   : acquisition to keep with filter ('x' or 'p2'), None to keep all rows
+       plot_file: optional file to save the graph of the fit to
+
+    Returns a dict which can be written as JSON: the number of sessions, R2, parameters, p-values and
+    FDR-corrected p-values of the fit, and the date, value, prediction and residual of the latest session.
+    """
+    df = (qa if option is None else filter(option, qa)).copy()
+    fit = regress(target, df, plot=plot_file is not None, print_summary=False, fast=True,
+                  plot_file=plot_file or "test.svg")
+    latest = df.loc[fit.predictions.index, 'Date'].idxmax()
+    return {
+        'target': target,
+        'sessions': len(fit.predictions),
+        'rsquared': float(fit.rsquared),
+        'params': fit.params.astype(float).to_dict(),
+        'pvalues': fit.pvalues.astype(float).to_dict(),
+        'f_pvalues': {test: float(p) for test, p in fit.f_pvalues.items()},
+        'fdr': fit.fdr['FDR-corrected'].astype(float).to_dict(),
+        'significant_variables': list(fit.significant_variables),
+        'latest': {'Date': df.loc[latest, 'Date'].strftime('%Y-%m-%d'),
+                   'value': float(df.loc[latest, target]),
+                   'prediction': float(fit.predictions[latest]),
+                   'residual': float(df.loc[latest, target] - fit.predictions[latest])},
+    }
+
+
+# results of fit_targets: params, bse, pvalues are (variables x targets) arrays, fvalues and f_pvalues are
+# (f_tests x targets) arrays, rsquared, nobs and df_resid have one value per target
+MultiFit = namedtuple('MultiFit', ['targets', 'variables', 'params', 'bse', 'pvalues', 'rsquared',
+                                   'f_tests', 'fvalues', 'f_pvalues', 'nobs', 'df_resid'])
+
+
+def fit_targets(targets, model_df, add_qa=True, add_seasonal=True, real_data=False):
+    """
+    fits the model of regress to many targets at once
+
+    Parameters
+    ----------
+       targets     : list of str, the columns of model_df to model, e.g. segstats regions
+       model_df    : pandas DataFrame with data to be used for predictive modeling
+       add_qa, add_seasonal, real_data: as for regress
+
+    The design is built and factored once and every target is solved from the same factorization,
+    as a single matrix right-hand side (see fit_design). Estimates match those of
+    sm.OLS in regress (nonrobust covariance).
+
+    Returns a MultiFit.
+    """
+    X, Y, _, f_tests_todo, factorization = build_design(list(targets), model_df, add_qa=add_qa,
+                                                        add_seasonal=add_seasonal, real_data=real_data)
+    return fit_design(X, Y, f_tests_todo, factorization)
+
+
+def _pinv(X, factorization=None):
+    """
+    pseudo-inverse of design X, the normalized covariance of its parameters and its rank, from the
+    factorization of X returned by build_design if given (and not None), with a SVD otherwise
+    """
+    if factorization is None:
+        pinv_X = np.linalg.pinv(X)
+        return pinv_X, np.dot(pinv_X, pinv_X.T), np.linalg.matrix_rank(X)
+    from scipy.linalg import solve_triangular
+
+    Q, R, columns = factorization
+    R_inv = solve_triangular(R, np.eye(len(R)))
+    # the other columns of X are zeros, whose parameters the pseudo-inverse sets to 0
+    pinv_X = np.zeros((X.shape[1], len(X)))
+    pinv_X[columns] = np.dot(R_inv, Q.T)
+    cov = np.zeros((X.shape[1], X.shape[1]))
+    cov[np.ix_(columns, columns)] = np.dot(R_inv, R_inv.T)
+    return pinv_X, cov, len(columns)
+
+
+def fit_design(X, Y, f_tests_todo=(), factorization=None):
+    """
+    fits every column of the DataFrame Y against the design X (as returned by build_design)
+
+    Samples where a target is missing are left out of its fit, so targets are grouped by their pattern of
+    missing samples. Targets without missing samples are solved from `factorization`, the QR factorization
+    of X returned by build_design; X is factored again (by a SVD) for every other pattern. F-tests are done
+    for the prefixes of f_tests_todo which have variables in X.
+
+    Returns a MultiFit.
+    """
+    from scipy import stats
+
+    targets = list(Y.columns)
+    variables = list(X.columns)
+    X = X.to_numpy()
+    Y = Y.to_numpy(dtype=float)
+    n_vars, n_targets = X.shape[1], Y.shape[1]
+    f_columns = [[i for i, v in enumerate(variables) if v.startswith(prefix)] for prefix in f_tests_todo]
+    f_tests = [prefix for prefix, columns in zip(f_tests_todo, f_columns) if columns]
+
+    params = np.full((n_vars, n_targets), np.nan)
+    bse = np.full((n_vars, n_targets), np.nan)
+    rsquared = np.full(n_targets, np.nan)
+    fvalues = np.full((len(f_tests), n_targets), np.nan)
+    nobs = np.zeros(n_targets, dtype=int)
+    df_resid = np.zeros(n_targets)
+
+    present = np.isfinite(Y)
+    patterns = {}
+    for j in range(n_targets):
+        patterns.setdefault(present[:, j].tobytes(), []).append(j)
+
+    for group in patterns.values():
+        rows = present[:, group[0]]
+        Xs, Ys = X[rows], Y[np.ix_(rows, group)]
+        # cov: normalized covariance of the parameters
+        pinv_X, cov, rank = _pinv(Xs, factorization if rows.all() else None)
+        beta = np.dot(pinv_X, Ys)
+        resid = Ys - np.dot(Xs, beta)
+        dof = len(Xs) - rank
+        scale = (resid ** 2).sum(axis=0) / dof
+        centered = Ys - Ys.mean(axis=0)
+
+        params[:, group] = beta
+        bse[:, group] = np.sqrt(np.outer(np.diag(cov), scale))
+        rsquared[group] = 1 - (resid ** 2).sum(axis=0) / (centered ** 2).sum(axis=0)
+        nobs[group] = len(Xs)
+        df_resid[group] = dof
+
+        # Wald F-test of all the variables with a given prefix being 0, as Ftest does
+        for k, columns in enumerate(c for c in f_columns if c):
+            b = beta[columns]
+            inv_cov = np.linalg.pinv(cov[np.ix_(columns, columns)])
+            fvalues[k, group] = (b * np.dot(inv_cov, b)).sum(axis=0) / (len(columns) * scale)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvalues = params / bse
+    pvalues = 2 * stats.t.sf(np.abs(tvalues), df_resid)
+    f_dfs = np.array([len(c) for c in f_columns if c]).reshape(-1, 1)
+    f_pvalues = stats.f.sf(fvalues, f_dfs, df_resid)
+
+    return MultiFit(targets, variables, params, bse, pvalues, rsquared,
+                    f_tests, fvalues, f_pvalues, nobs, df_resid)
+
+
 def scrape_var_significance(targets, p_var, df):
-    dummy = [] # dud list for Seasonal f test comparison
+    targets = list(targets)
     columns = ['Variable', p_var + ' p value', 'R2 value']
-    result = pd.DataFrame(columns = columns)
-    raw_pvals = []
-    
+    input_df = pd.DataFrame(df, columns=['Date', 'sid', 'ses', 'age', 'tsnr',
+                                         'snr_total_qa', 'IOPD1_real', 'IOPD2_real', 'IOPD3_real', 
+                                         'IOPD4_real', 'IOPD5_real', 'IOPD6_real', 'sex_male', 'PatientWeight'])
     for target in targets:
-        input_df = pd.DataFrame(df,columns=['Date', 'sid', 'ses', target, 'age', 'tsnr',
-                                             'snr_total_qa', 'IOPD1_real', 'IOPD2_real', 'IOPD3_real', 
-                                             'IOPD4_real', 'IOPD5_real', 'IOPD6_real', 'sex_male', 'PatientWeight'])
-        model = regress(target, input_df, plot=False, print_summary=False, real_data=True)
-        
-        if p_var == 'Seasonal':
-            seasonal_ftest = Ftest(model, 'Seasonal', dummy).pvalue
-            result.loc[len(result)] = [target, seasonal_ftest, model.rsquared]
-            raw_pvals.append(seasonal_ftest)
-            
-        else:
-            var_pval = model.pvalues[p_var]
-            result.loc[len(result)] = [target, var_pval, model.rsquared]
-            raw_pvals.append(var_pval)
+        input_df[target] = df[target]
+    # all targets are fitted at once against the same design
+    fit = fit_targets(targets, input_df, real_data=True)
+    
+    if p_var in fit.f_tests:
+        raw_pvals = fit.f_pvalues[fit.f_tests.index(p_var)]
+    else:
+        raw_pvals = fit.pvalues[fit.variables.index(p_var)]
+    result = pd.DataFrame(dict(zip(columns, [targets, raw_pvals, fit.rsquared])), columns=columns)
             
     fdr_df = pd.DataFrame({'FDR-corrected': fdrcorrection(raw_pvals)[1].tolist()})
     result = result.join(fdr_df)
         
     return result
+
+
+# environment variables limiting the threads of the BLAS libraries numpy may be linked against
+blas_thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def _limit_blas_threads(n_threads):
+    # the environment is only read when BLAS is loaded; threadpoolctl also limits already loaded ones
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def pool_map(function, tasks, jobs):
+    """
+    maps `function` over `tasks` on a pool of `jobs` spawned processes, each with a single BLAS thread
+    and the non-interactive Agg matplotlib backend, or in this process if jobs is 1
+    """
+    if jobs == 1:
+        return [function(task) for task in tasks]
+    # spawned processes pick up the environment when they start, before loading numpy
+    environment = dict({var: '1' for var in blas_thread_vars}, MPLBACKEND='Agg')
+    saved = {var: os.environ.get(var) for var in environment}
+    os.environ.update(environment)
+    try:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(jobs, initializer=_limit_blas_threads, initargs=(1,)) as pool:
+            return pool.map(function, tasks)
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _fit_chunk(args):
+    targets, chunk_df, kwargs = args
+    return fit_targets(targets, chunk_df, **kwargs)
+
+
+def sweep_significance(targets, variables, df, jobs=None, add_qa=True, add_seasonal=True, real_data=True):
+    """
+    tests every variable of `variables` for every target of `targets`, in parallel
+
+    Parameters
+    ----------
+       targets     : list of str, the columns of df to model
+       variables   : list of str, variables of the model (e.g. 'age', 'snr_total_qa') or prefixes of F-tested
+                     variables ('Seasonal', 'IOPD')
+       df          : pandas DataFrame with the data
+       jobs        : number of processes (default: all cores)
+       add_qa, add_seasonal, real_data: as for regress
+
+    The targets are split in chunks fitted with fit_targets by a pool of processes, each with a single
+    BLAS thread so that the processes do not oversubscribe the cores.
+
+    Returns a DataFrame with one row per variable and target: the coefficient (NaN for F-tests), its t
+    (or F) statistic, p value, R2 value of the model, and the p value FDR-corrected across all targets
+    for that variable.
+    """
+    targets = list(targets)
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(targets)) or 1
+    kwargs = dict(add_qa=add_qa, add_seasonal=add_seasonal, real_data=real_data)
+
+    other_targets = set(targets)
+    design_df = df[[c for c in df.columns if c not in other_targets]]
+    chunks = [targets[i::jobs] for i in range(jobs)]
+    tasks = [(chunk, pd.concat([design_df, df[chunk]], axis=1), kwargs) for chunk in chunks]
+
+    fits = pool_map(_fit_chunk, tasks, jobs)
+
+    tables = []
+    for fit in fits:
+        for variable in variables:
+            if variable in fit.f_tests:
+                k = fit.f_tests.index(variable)
+                coef = np.full(len(fit.targets), np.nan)
+                statistic, pvalue = fit.fvalues[k], fit.f_pvalues[k]
+            else:
+                k = fit.variables.index(variable)
+                coef, pvalue = fit.params[k], fit.pvalues[k]
+                statistic = coef / fit.bse[k]
+            tables.append(pd.DataFrame({'Variable': variable, 'Target': fit.targets, 'coef': coef,
+                                        'statistic': statistic, 'p value': pvalue, 'R2 value': fit.rsquared}))
+
+    result = pd.concat(tables, ignore_index=True)
+    # restore the order in which targets were given
+    result['Target'] = pd.Categorical(result['Target'], categories=targets)
+    result['Variable'] = pd.Categorical(result['Variable'], categories=list(variables))
+    result = result.sort_values(['Variable', 'Target']).reset_index(drop=True)
+    result['FDR-corrected'] = result.groupby('Variable')['p value'].transform(lambda p: fdrcorrection(p)[1])
+    return result
+
+
+def _resampled_rows(rng, n, size, method, block_length):
+    """
+    indices of `size` resamples of n rows (ordered in time), as an array of shape (size, n)
+    """
+    if method == 'bootstrap':
+        # moving block bootstrap: blocks starting anywhere, drawn with replacement
+        starts = rng.integers(0, n - block_length + 1, (size, -(-n // block_length)))
+        return (starts[:, :, None] + np.arange(block_length)).reshape(size, -1)[:, :n]
+    if block_length == 1:
+        # random keys rather than Generator.permuted, which needs NumPy 1.20
+        return np.argsort(rng.random((size, n)), axis=1)
+    # block permutation: shuffle contiguous blocks, keeping the order within each block
+    blocks = np.arange(n) // block_length
+    ranks = rng.random((size, blocks[-1] + 1)).argsort(axis=1)
+    return np.argsort(ranks[:, blocks] * n + np.arange(n), axis=1)
+
+
+def _statistics(X, pinv_X, cov, dof, Y, columns):
+    """
+    t (one column) or F (several columns) statistics of `columns` of X for every column of Y
+    """
+    beta = np.dot(pinv_X, Y)
+    resid = Y - np.dot(X, beta)
+    scale = (resid ** 2).sum(axis=0) / dof
+    b = beta[columns]
+    if len(columns) == 1:
+        # NaN for the zero columns of variables spanned by the preceding ones
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return b[0] / np.sqrt(cov[columns[0], columns[0]] * scale)
+    inv_cov = np.linalg.pinv(cov[np.ix_(columns, columns)])
+    return (b * np.dot(inv_cov, b)).sum(axis=0) / (len(columns) * scale)
+
+
+def resample_significance(target_variable, model_df, n_resamples=5000, method='permutation', block_length=1,
+                          chunk_size=1000, seed=None, add_qa=True, add_seasonal=True, real_data=False):
+    """
+    permutation or block bootstrap p-values of the variables of the model of regress
+
+    Parameters
+    ----------
+       target_variable: the column of model_df to model
+       model_df       : pandas DataFrame with data to be used for predictive modeling
+       n_resamples    : number of permuted or resampled target vectors
+       method         : 'permutation' (of single samples, or of contiguous blocks if block_length > 1) or
+                        'bootstrap' (moving block bootstrap)
+       block_length   : number of consecutive samples (ordered by date) kept together, to preserve the
+                        temporal autocorrelation of the series
+       chunk_size     : number of resamples evaluated at once, bounding memory to n x chunk_size values
+       seed           : seed of the random generator
+       add_qa, add_seasonal, real_data: as for regress
+
+    Every single variable is tested with its t statistic, and the Shim, IOPD and Seasonal variables jointly
+    with an F statistic. Resampling follows Freedman & Lane: the residuals of the model without the tested
+    variables are resampled and added back to its fit, and the full model is refitted. The design is
+    factored once; the resampled targets of a chunk are fitted together as one matrix right-hand side.
+
+    Returns a DataFrame with the statistic, its parametric p value and the resampled p value of every test.
+    """
+    from scipy import stats
+
+    if method not in ('permutation', 'bootstrap'):
+        raise ValueError("method must be 'permutation' or 'bootstrap', not %r" % method)
+    X, y, dates, _, factorization = build_design(target_variable, model_df, add_qa=add_qa,
+                                                 add_seasonal=add_seasonal, real_data=real_data)
+    y = y[target_variable]
+    present = np.isfinite(y.to_numpy(dtype=float))
+    order = np.argsort(dates.to_numpy()[present], kind='stable')
+    variables = list(X.columns)
+    X = X.to_numpy()[present]
+    y = y.to_numpy(dtype=float)[present][order]
+    n = len(y)
+
+    # the factorization of build_design holds for all samples, taken in the order of the dates
+    pinv_X, cov, rank = _pinv(X, factorization if present.all() else None)
+    X, pinv_X = X[order], pinv_X[:, order]
+    dof = n - rank
+
+    tests = [(v, [i]) for i, v in enumerate(variables) if v != 'const']
+    for prefix in ['Shim', 'IOPD', 'Seasonal']:
+        columns = [i for i, v in enumerate(variables) if v.startswith(prefix)]
+        if columns:
+            tests.append((prefix, columns))
+
+    rng = np.random.default_rng(seed)
+    result = []
+    for name, columns in tests:
+        observed = _statistics(X, pinv_X, cov, dof, y[:, None], columns)[0]
+        if np.isnan(observed):
+            # a variable spanned by the preceding ones, which is not in the model
+            result.append([name, observed, np.nan, np.nan])
+            continue
+        # fit and residuals of the model without the tested variables
+        Z = np.delete(X, columns, axis=1)
+        fitted = np.dot(Z, np.dot(np.linalg.pinv(Z), y))
+        resid = y - fitted
+
+        exceed = 0
+        for start in range(0, n_resamples, chunk_size):
+            size = min(chunk_size, n_resamples - start)
+            rows = _resampled_rows(rng, n, size, method, block_length)
+            Y = fitted[:, None] + resid[rows].T
+            resampled = _statistics(X, pinv_X, cov, dof, Y, columns)
+            if len(columns) == 1:
+                exceed += np.sum(np.abs(resampled) >= np.abs(observed))
+            else:
+                exceed += np.sum(resampled >= observed)
+
+        if len(columns) == 1:
+            pvalue = 2 * stats.t.sf(np.abs(observed), dof)
+        else:
+            pvalue = stats.f.sf(observed, len(columns), dof)
+        result.append([name, observed, pvalue, (exceed + 1) / (n_resamples + 1)])
+
+    return pd.DataFrame(result, columns=['Variable', 'statistic', 'p value', 'resampled p value'])